@@ -0,0 +1,254 @@
+# A local stand-in for the Druid broker's druid/v2 endpoint, for benchmarks. Answers
+# timeseries, groupBy and topN queries on pageviews_hourly and banner_activity_minutely
+# with synthetic data. Only filters selecting synthetic dimension values (such as
+# 'country_code3') are applied, so that filtering for top groups works.
+#
+# Usage (standalone): python benchmarks/fake_druid.py [port]
+
+import json, os, random, sys, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Import the package from this checkout, even if it isn't installed
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
+
+import centralnotice_analytics.util.intervals as intervals
+
+DATASOURCES = [ 'pageviews_hourly', 'banner_activity_minutely' ]
+
+INTEGER_AGGREGATOR_TYPES = [ 'count', 'longSum', 'longMin', 'longMax' ]
+
+
+class FakeDruid:
+    """A fake Druid broker running on a background thread.
+
+    Each time bucket of a timeseries query gets one row. Each time bucket of a groupBy
+    query gets cardinality rows, one for each combination of dimension values, with
+    values skewed so that a few groups have most of the total. Counts of requests and
+    bytes sent are kept, to report data transferred.
+    """
+
+    def __init__( self, port = 0, cardinality = 20, latency = 0.0, seed = 0 ):
+        """
+        :param int port: Port to listen on (0 to pick a free port).
+        :param int cardinality: Number of groups for each time bucket of groupBy
+            queries.
+        :param float latency: Seconds to wait before answering each query.
+        :param int seed: Seed for synthetic values.
+        """
+        self.cardinality = cardinality
+        self.latency = latency
+        self.seed = seed
+
+        self.request_count = 0
+        self.bytes_sent = 0
+        self._counter_lock = threading.Lock()
+
+        self._server = ThreadingHTTPServer( ( '127.0.0.1', port ), _make_handler( self ) )
+        self._server.daemon_threads = True
+        self._thread = None
+
+
+    @property
+    def url( self ):
+        return 'http://127.0.0.1:{0}'.format( self._server.server_address[ 1 ] )
+
+
+    def start( self ):
+        self._thread = threading.Thread( target = self._server.serve_forever,
+            daemon = True )
+        self._thread.start()
+        return self
+
+
+    def stop( self ):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+    def reset_counters( self ):
+        with self._counter_lock:
+            self.request_count = 0
+            self.bytes_sent = 0
+
+
+    def answer( self, query ):
+        """Return the result for a query, in the form Druid would return it."""
+        if ( query.get( 'dataSource' ) not in DATASOURCES ):
+            raise ValueError(
+                'Unknown datasource {0}'.format( query.get( 'dataSource' ) ) )
+
+        query_type = query[ 'queryType' ]
+        aggregations = query[ 'aggregations' ]
+        rng = random.Random( self.seed )
+
+        timestamps = [
+            intervals.format_timestamp( ts ).replace( 'Z', '.000Z' )
+            for ts in _bucket_starts( query[ 'intervals' ], query[ 'granularity' ] )
+        ]
+
+        if ( query_type == 'timeseries' ):
+            return [
+                { 'timestamp': ts, 'result': _values( aggregations, rng, 1.0 ) }
+                for ts in timestamps
+            ]
+
+        if ( query_type == 'groupBy' ):
+            dimensions = [
+                d if isinstance( d, str ) else d[ 'outputName' ]
+                for d in query[ 'dimensions' ]
+            ]
+
+            groups = [
+                ( i, { d: '{0}{1}'.format( d, i ) for d in dimensions } )
+                for i in range( self.cardinality )
+            ]
+            groups = [ g for g in groups
+                if _matches( query.get( 'filter' ), g[1] ) is not False ]
+
+            rows = []
+            for ts in timestamps:
+                for i, group in groups:
+                    event = dict( group, **_values( aggregations, rng, 1.0 / ( i + 1 ) ) )
+                    rows.append( { 'version': 'v1', 'timestamp': ts, 'event': event } )
+
+            limit = ( query.get( 'limitSpec' ) or {} ).get( 'limit' )
+            return rows[ :limit ] if limit else rows
+
+        if ( query_type == 'topN' ):
+            dimension = query[ 'dimension' ]
+            groups = [
+                ( i, { dimension: '{0}{1}'.format( dimension, i ) } )
+                for i in range( self.cardinality )
+            ]
+            groups = [ g for g in groups
+                if _matches( query.get( 'filter' ), g[1] ) is not False ]
+            groups = groups[ :query[ 'threshold' ] ]
+
+            return [ {
+                'timestamp': ts,
+                'result': [
+                    dict( group, **_values( aggregations, rng, 1.0 / ( i + 1 ) ) )
+                    for i, group in groups
+                ]
+            } for ts in timestamps ]
+
+        raise ValueError( 'Unsupported query type {0}'.format( query_type ) )
+
+
+    def _count( self, byte_count ):
+        with self._counter_lock:
+            self.request_count += 1
+            self.bytes_sent += byte_count
+
+
+def _bucket_starts( query_intervals, granularity ):
+    if ( isinstance( query_intervals, list ) ):
+        query_intervals = query_intervals[0]
+
+    start, end = intervals.parse_interval( query_intervals )
+
+    if ( intervals.bucket_size( granularity ) is None ):
+        return [ start ]
+
+    # As in Druid, buckets are aligned to the granularity, and the first one may start
+    # before the interval
+    return intervals.bucket_starts(
+        intervals.bucket_floor( start, granularity ), end, granularity )
+
+
+def _matches( druid_filter, event ):
+    # Evaluate a filter on a group's dimension values. Returns None where the result
+    # depends on dimensions not in the group or on non-synthetic values, and such groups
+    # are included.
+    if ( druid_filter is None ):
+        return True
+
+    filter_type = druid_filter.get( 'type', 'selector' )
+
+    if ( filter_type in ( 'and', 'or' ) ):
+        results = [ _matches( f, event ) for f in druid_filter[ 'fields' ] ]
+        decisive = False if filter_type == 'and' else True
+        if ( decisive in results ):
+            return decisive
+
+        return None if None in results else not decisive
+
+    if ( filter_type == 'not' ):
+        result = _matches( druid_filter[ 'field' ], event )
+        return None if result is None else not result
+
+    dimension = druid_filter.get( 'dimension' )
+    if ( dimension not in event ):
+        return None
+
+    if ( filter_type == 'selector' ):
+        values = [ druid_filter[ 'value' ] ]
+    elif ( filter_type == 'in' ):
+        values = druid_filter[ 'values' ]
+    else:
+        return None
+
+    if ( not any( str( v ).startswith( dimension ) for v in values ) ):
+        return None
+
+    return event[ dimension ] in values
+
+
+def _values( aggregations, rng, weight ):
+    values = {}
+    for aggregation in aggregations:
+        value = 100000 * weight * ( 0.5 + rng.random() )
+        if ( aggregation[ 'type' ] in INTEGER_AGGREGATOR_TYPES ):
+            values[ aggregation[ 'name' ] ] = int( value / 10 )
+        else:
+            values[ aggregation[ 'name' ] ] = float( int( value ) )
+
+    return values
+
+
+def _make_handler( fake ):
+
+    class Handler( BaseHTTPRequestHandler ):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message( self, format, *args ):
+            pass
+
+
+        def do_POST( self ):
+            query = json.loads( self.rfile.read( int( self.headers[ 'Content-Length' ] ) ) )
+
+            if ( fake.latency ):
+                time.sleep( fake.latency )
+
+            try:
+                status = 200
+                body = json.dumps( fake.answer( query ) ).encode( 'utf-8' )
+            except ( KeyError, ValueError ) as e:
+                status = 500
+                body = json.dumps( {
+                    'error': 'Unknown exception',
+                    'errorMessage': str( e )
+                } ).encode( 'utf-8' )
+
+            self.send_response( status )
+            self.send_header( 'Content-Type', 'application/json' )
+            self.send_header( 'Content-Length', str( len( body ) ) )
+            self.end_headers()
+            self.wfile.write( body )
+
+            fake._count( len( body ) )
+
+    return Handler
+
+
+if __name__ == '__main__':
+    port = int( sys.argv[ 1 ] ) if len( sys.argv ) > 1 else 8082
+    fake = FakeDruid( port ).start()
+    print( 'Fake Druid broker at {0}/druid/v2'.format( fake.url ) )
+
+    try:
+        while True:
+            time.sleep( 3600 )
+    except KeyboardInterrupt:
+        fake.stop()
@@ -0,0 +1,46 @@
+# Measure the time to import centralnotice_analytics in a fresh interpreter, and check
+# that heavy dependencies are not loaded on import. Exits with status 1 if the median
+# import time is over budget, or if a heavy dependency was loaded.
+#
+# Usage: python benchmarks/import_benchmark.py [budget_ms] [runs]
+
+import json, os, statistics, subprocess, sys
+
+HEAVY_MODULES = [ 'pandas', 'numpy', 'matplotlib', 'pydruid', 'yaml' ]
+
+MEASURE_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import centralnotice_analytics
+elapsed = time.perf_counter() - start
+print( json.dumps( {
+    'ms': elapsed * 1000,
+    'loaded': [ m for m in %r if m in sys.modules ]
+} ) )
+""" % ( HEAVY_MODULES, )
+
+
+def measure_import():
+    repo_dir = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..' )
+    output = subprocess.check_output(
+        [ sys.executable, '-c', MEASURE_SCRIPT ], cwd = repo_dir )
+
+    return json.loads( output.decode( 'utf-8' ) )
+
+
+if __name__ == '__main__':
+    budget_ms = float( sys.argv[ 1 ] ) if len( sys.argv ) > 1 else 100
+    runs = int( sys.argv[ 2 ] ) if len( sys.argv ) > 2 else 10
+
+    results = [ measure_import() for i in range( runs ) ]
+    median_ms = statistics.median( r[ 'ms' ] for r in results )
+    loaded = sorted( set( m for r in results for m in r[ 'loaded' ] ) )
+
+    print( 'Median import time: {0:.1f} ms (budget {1:.0f} ms, {2} runs)'.format(
+        median_ms, budget_ms, runs ) )
+
+    if ( loaded ):
+        print( 'Heavy modules loaded on import: {0}'.format( ', '.join( loaded ) ) )
+
+    if ( ( median_ms > budget_ms ) or loaded ):
+        sys.exit( 1 )
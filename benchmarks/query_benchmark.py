@@ -0,0 +1,148 @@
+# Benchmark queries against a local fake Druid broker with synthetic data (see
+# fake_druid.py). For each scenario, reports the best wall time of several runs, the
+# peak memory allocated by Python during a run (measured by tracemalloc, in a separate
+# run), and the number of requests and bytes received from the broker.
+#
+# Usage: python benchmarks/query_benchmark.py [--days N] [--cardinality N]
+#     [--latency SECONDS] [--repeat N] [scenario ...]
+
+import argparse, os, sys, time, tracemalloc
+
+import yaml
+
+# Import the package from this checkout, even if it isn't installed, and fake_druid
+# from this directory
+BENCHMARKS_DIR = os.path.dirname( os.path.abspath( __file__ ) )
+sys.path[ 0:0 ] = [ os.path.dirname( BENCHMARKS_DIR ), BENCHMARKS_DIR ]
+
+import centralnotice_analytics as cna
+import centralnotice_analytics.util.py_druid_util as py_d_util
+from fake_druid import FakeDruid
+
+
+def configure( fake ):
+    """Use config_example.yaml, with queries sent to the fake broker and caches
+    disabled."""
+    repo_dir = os.path.dirname( BENCHMARKS_DIR )
+    with open( os.path.join( repo_dir, 'config_example.yaml' ), 'r' ) as stream:
+        config = yaml.safe_load( stream )
+
+    config[ 'druid' ].update( { 'url': fake.url, 'endpoint': 'druid/v2' } )
+    config[ 'result_cache' ] = { 'enabled': False }
+    config[ 'project_index' ] = { 'enabled': False }
+
+    cna.config = config
+    py_d_util.py_druid_query = None
+
+
+def make_scenarios( interval ):
+    campaign_spec = cna.CampaignSpec(
+        name_regex = 'C1718_en6C',
+        projects = [ 'wikipedia' ],
+        languages = [ 'en' ],
+        countries = [ 'CA', 'US' ],
+        devices = [ 'iphone', 'ipad', 'android' ]
+    )
+
+    def pageviews():
+        return cna.PageviewsQuery( campaign_spec, interval, 'hour' )
+
+    def grouped_pageviews():
+        return cna.PageviewsQuery( campaign_spec, interval, 'hour',
+            group_by_cols = [ 'country_code', 'ua_browser_family' ] )
+
+    def top_grouped_pageviews():
+        return cna.PageviewsQuery( campaign_spec, interval, 'hour',
+            group_by_cols = [ 'country_code', 'ua_browser_family' ], top_groups = 5 )
+
+    def top_grouped_impressions():
+        return cna.ImpressionsQuery( campaign_spec, interval, 'hour',
+            group_by_cols = [ 'country' ], top_groups = 5 )
+
+    def impressions():
+        return cna.ImpressionsQuery( campaign_spec, interval, 'hour' )
+
+    def grouped_impressions():
+        return cna.ImpressionsQuery( campaign_spec, interval, 'hour',
+            group_by_cols = [ 'country' ] )
+
+    def rates():
+        return cna.RatesQuery( campaign_spec, interval, 'hour' )
+
+    def fetched( make_query ):
+        query = make_query()
+        query.pandas_df()
+        return query
+
+    def prepare_plot( query ):
+        # Plots are drawn on their own figures, so there's no pyplot state to clear
+        query.prepare_plot()
+
+    # Each scenario has a setup function, whose result is passed to a run function.
+    # Only the run function is measured.
+    return {
+        'pageviews': ( pageviews, lambda q: q.pandas_df() ),
+        'pageviews_grouped': ( grouped_pageviews, lambda q: q.pandas_df() ),
+        'pageviews_top_groups': ( top_grouped_pageviews, lambda q: q.pandas_df() ),
+        'impressions': ( impressions, lambda q: q.pandas_df() ),
+        'impressions_grouped': ( grouped_impressions, lambda q: q.pandas_df() ),
+        'impressions_top_groups': ( top_grouped_impressions, lambda q: q.pandas_df() ),
+        'rates': ( rates, lambda q: q.pandas_df() ),
+        'flatten': (
+            lambda: fetched( grouped_pageviews ),
+            lambda q: q.flatten_df_with_top_values( 'pageviews', 5, 'other' )
+        ),
+        'plot_rates': ( lambda: fetched( rates ), prepare_plot ),
+        'plot_grouped': ( lambda: fetched( grouped_pageviews ), prepare_plot )
+    }
+
+
+def measure( fake, setup, run, repeat ):
+    wall_times = []
+    for i in range( repeat ):
+        state = setup()
+        start = time.perf_counter()
+        run( state )
+        wall_times.append( time.perf_counter() - start )
+
+    state = setup()
+    fake.reset_counters()
+    tracemalloc.start()
+    run( state )
+    peak = tracemalloc.get_traced_memory()[ 1 ]
+    tracemalloc.stop()
+
+    return min( wall_times ), peak, fake.request_count, fake.bytes_sent
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument( 'scenarios', nargs = '*' )
+    parser.add_argument( '--days', type = int, default = 30 )
+    parser.add_argument( '--cardinality', type = int, default = 50 )
+    parser.add_argument( '--latency', type = float, default = 0.0 )
+    parser.add_argument( '--repeat', type = int, default = 3 )
+    args = parser.parse_args()
+
+    import matplotlib
+    matplotlib.use( 'Agg' )
+
+    fake = FakeDruid( cardinality = args.cardinality, latency = args.latency ).start()
+    configure( fake )
+
+    scenarios = make_scenarios( '2017-12-01T00:00Z/P{0}D'.format( args.days ) )
+    names = args.scenarios or list( scenarios )
+
+    print( '{0} days, cardinality {1}, latency {2} s'.format(
+        args.days, args.cardinality, args.latency ) )
+    print( '{0:<24} {1:>10} {2:>12} {3:>9} {4:>12}'.format(
+        'scenario', 'wall s', 'peak MiB', 'requests', 'KiB received' ) )
+
+    for name in names:
+        setup, run = scenarios[ name ]
+        wall_time, peak, requests, received = measure( fake, setup, run, args.repeat )
+
+        print( '{0:<24} {1:>10.4f} {2:>12.2f} {3:>9} {4:>12.1f}'.format(
+            name, wall_time, peak / 2**20, requests, received / 2**10 ) )
+
+    fake.stop()
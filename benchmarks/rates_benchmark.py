@@ -0,0 +1,56 @@
+# Compare row-wise and vectorized computation of RatesQuery's derived columns.
+#
+# Usage: python benchmarks/rates_benchmark.py [rows ...]
+
+import os, sys, timeit
+
+import numpy
+import pandas
+
+# Import the package from this checkout, even if it isn't installed
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
+
+from centralnotice_analytics.rates_query import RatesQuery
+
+
+def make_merged_df( rows ):
+    """Make a dataframe like the left merge of pageviews and impressions in
+    RatesQuery, with some buckets missing impressions and some with no pageviews."""
+    rng = numpy.random.default_rng( 0 )
+    pageviews = rng.integers( 0, 1000000, rows ).astype( 'float64' )
+    impressions = rng.integers( 0, 100000, rows ).astype( 'float64' )
+    impressions[ rng.random( rows ) < 0.01 ] = numpy.nan
+
+    return pandas.DataFrame( {
+        'timestamp': pandas.date_range( '2017-12-01', periods = rows, freq = 'min' ),
+        'pageviews': pageviews,
+        'impressions': impressions
+    } )
+
+
+def row_wise( df ):
+    df[ 'rate' ] = df.apply( lambda row: row.impressions/row.pageviews, axis = 1 )
+    df[ 'difference' ] = df.apply( lambda row: row.pageviews - row.impressions, axis = 1 )
+
+
+def vectorized( df ):
+    RatesQuery.add_rate_columns( df )
+
+
+def best_time( func, df, repeat ):
+    return min( timeit.repeat( lambda: func( df.copy() ), number = 1, repeat = repeat ) )
+
+
+if __name__ == '__main__':
+    sizes = [ int( a ) for a in sys.argv[ 1: ] ] or [ 100000, 1000000 ]
+
+    print( '{0:>10} {1:>12} {2:>12} {3:>9}'.format(
+        'rows', 'row-wise s', 'vectorized s', 'speedup' ) )
+
+    for rows in sizes:
+        df = make_merged_df( rows )
+        row_wise_time = best_time( row_wise, df, 1 )
+        vectorized_time = best_time( vectorized, df, 5 )
+
+        print( '{0:>10} {1:>12.3f} {2:>12.4f} {3:>8.0f}x'.format(
+            rows, row_wise_time, vectorized_time, row_wise_time / vectorized_time ) )
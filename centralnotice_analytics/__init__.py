@@ -1,19 +1,98 @@
-import yaml, os
-import pandas
+import hashlib, importlib, os, pickle
 
-from .campaign_spec import CampaignSpec
-from .timeseries_plot import TimeSeriesPlot
-from .pageviews_query import PageviewsQuery
-from .impressions_query import ImpressionsQuery
-from .rates_query import RatesQuery
+# Public classes and config are loaded on first access, so that importing the package
+# is fast, and doesn't load pandas, matplotlib or pydruid, or require a config file.
+_lazy_classes = {
+    'CampaignSpec': 'centralnotice_analytics.campaign_spec',
+    'TimeSeriesPlot': 'centralnotice_analytics.timeseries_plot',
+    'PageviewsQuery': 'centralnotice_analytics.pageviews_query',
+    'ImpressionsQuery': 'centralnotice_analytics.impressions_query',
+    'RatesQuery': 'centralnotice_analytics.rates_query',
+    'QueryBatch': 'centralnotice_analytics.query_batch',
+    'PageviewsCube': 'centralnotice_analytics.pageviews_cube',
+    'StoredQuery': 'centralnotice_analytics.stored_query',
+    'load_query': 'centralnotice_analytics.stored_query'
+}
 
 path = os.path.dirname( __file__ )
 config_filename = os.path.join( path, '../config.yaml' )
-with open( config_filename, 'r' ) as stream:
-    config = yaml.load( stream )
-
-# Prettier number displays
-pandas.set_option(
-    'display.float_format',
-    lambda x: '{:,.4f}'.format( x ) if x % 1 else '{:,.0f}'.format( x )
-)
\ No newline at end of file
+
+# The parsed config is cached in the user's cache directory, named for the config file,
+# so that checkouts sharing the directory don't overwrite each other's cache
+config_cache_filename = os.path.join(
+    os.environ.get( 'XDG_CACHE_HOME' ) or os.path.expanduser( '~/.cache' ),
+    'centralnotice_analytics',
+    'config-{0}.pickle'.format( hashlib.sha1(
+        os.path.abspath( config_filename ).encode( 'utf-8' ) ).hexdigest() )
+)
+
+
+def __getattr__( name ):
+    if ( name == 'config' ):
+        value = load_config()
+
+    elif ( name in _lazy_classes ):
+        value = getattr( importlib.import_module( _lazy_classes[ name ] ), name )
+
+    else:
+        raise AttributeError(
+            'module {0!r} has no attribute {1!r}'.format( __name__, name ) )
+
+    globals()[ name ] = value
+    return value
+
+
+def __dir__():
+    return sorted( list( globals() ) + list( _lazy_classes ) + [ 'config' ] )
+
+
+def load_config():
+    """Read config.yaml. The parsed config is cached in ~/.cache/centralnotice_analytics
+    (or under $XDG_CACHE_HOME), and the YAML is only parsed again (with the C loader,
+    if available) when the file changes."""
+    try:
+        stat = os.stat( config_filename )
+    except FileNotFoundError:
+        raise FileNotFoundError( ( 'Config file {0} not found. Copy ' +
+            'config_example.yaml as config.yaml to create it.' ).format(
+            config_filename ) ) from None
+
+    signature = ( stat.st_mtime_ns, stat.st_size )
+
+    try:
+        with open( config_cache_filename, 'rb' ) as stream:
+            cached_signature, cached_config = pickle.load( stream )
+
+        if ( cached_signature == signature ):
+            return cached_config
+
+    except ( OSError, EOFError, ValueError, pickle.UnpicklingError ):
+        pass
+
+    import yaml
+    loader = getattr( yaml, 'CSafeLoader', yaml.SafeLoader )
+
+    with open( config_filename, 'r' ) as stream:
+        config = yaml.load( stream, Loader = loader )
+
+    from centralnotice_analytics.util.files import atomic_write
+
+    # Caching is an optimization, so ignore errors (for example, from a read-only
+    # cache directory)
+    try:
+        with atomic_write( config_cache_filename ) as stream:
+            pickle.dump( ( signature, config ), stream )
+    except OSError:
+        pass
+
+    return config
+
+
+def set_display_options():
+    """Set Pandas options for prettier number displays."""
+    import pandas
+
+    pandas.set_option(
+        'display.float_format',
+        lambda x: '{:,.4f}'.format( x ) if x % 1 else '{:,.0f}'.format( x )
+    )
@@ -1,15 +1,55 @@
-import json
+import asyncio, hashlib, json, random, threading, time
+from concurrent.futures import ThreadPoolExecutor
 
+import pandas
 from pydruid.utils.filters import Filter
 from pydruid.client import QueryBuilder
 
+import centralnotice_analytics as cna
+import centralnotice_analytics.query_stats as query_stats
 import centralnotice_analytics.util.py_druid_util as py_d_util
+import centralnotice_analytics.util.intervals as intervals
+from centralnotice_analytics.util.druid_response import frame_for_query
+from centralnotice_analytics.result_cache import get_result_cache
 
 
 class DruidHelper:
 
-    def __init__( self, timeseries_args, group_by_cols = None ):
+    INTEGER_AGGREGATOR_TYPES = [ 'count', 'longSum', 'longMin', 'longMax' ]
+    """Types of Druid aggregators that produce integers."""
+
+    _compiled_filters = {}
+    _compiled_filters_lock = threading.Lock()
+
+    def __init__( self, timeseries_args, group_by_cols = None, shard_by = None,
+            compact_dtypes = None, stats = None, top_groups = None ):
+        """
+        :param dict timeseries_args: Arguments for a pydruid timeseries query.
+        :param list group_by_cols: A list of names of columns for grouping. If set, a
+            groupBy query is sent instead of a timeseries query.
+        :param str shard_by: ISO-8601 duration (for example, 'P1D' or 'P1W'). If set,
+            the query interval is split into chunks of this duration, which are fetched
+            concurrently and retried individually.
+        :param bool compact_dtypes: Return group-by columns as Categoricals, and
+            results of integer aggregators as int64. Defaults to True for grouped
+            queries.
+        :param centralnotice_analytics.query_stats.QueryStats stats: Object to record
+            timings and sizes on.
+        :param int top_groups: For grouped queries, only fetch results for this number
+            of groups with the highest totals of the first aggregation over the whole
+            interval (see _top_groups_query_args()).
+        """
         self._query_args = timeseries_args
+        self._stats = query_stats.DISABLED if stats is None else stats
+
+        # Normalize the filter, so logically identical queries serialize to the same
+        # JSON. This lets Druid's broker cache and our own caches recognize them.
+        if ( self._query_args.get( 'filter' ) is not None ):
+            compiled_filter = DruidHelper.compile_filter( self._query_args[ 'filter' ] )
+            if ( compiled_filter is None ):
+                del self._query_args[ 'filter' ]
+            else:
+                self._query_args[ 'filter' ] = compiled_filter
 
         if ( group_by_cols ):
             self._query_args[ 'dimensions' ] = group_by_cols
@@ -17,28 +57,410 @@ class DruidHelper:
         else:
             self._group_by = False
 
+        if ( shard_by ):
+            self._validate_shard_by( shard_by )
+
+        self._shard_by = shard_by
+
+        if ( top_groups and ( not self._group_by ) ):
+            raise ValueError( 'Top groups only available for grouped queries.' )
+
+        self._top_groups = top_groups
+        self._top_groups_helper = None
+
+        if ( compact_dtypes is None ):
+            compact_dtypes = self._group_by
+
+        self._compact_dtypes = compact_dtypes
+
 
     def pandas_df( self ):
-        # Get a configured client query object
-        query = py_d_util.get_py_druid_query()
+        return self.interval_pandas_df( self._query_args[ 'intervals' ] )
+
+
+    def interval_pandas_df( self, interval, refetch = False ):
+        """Return results of this query for a different interval.
+
+        :param str interval: ISO-8601 interval.
+        :param bool refetch: Fetch results from Druid even if they're in the result
+            cache, and update the cache with them.
+        """
+        if ( self._top_groups ):
+            if ( self._top_groups_helper is None ):
+                method, args = self._top_groups_query_args()
+                query = getattr( py_d_util.get_py_druid_query(), method )( **args )
+                self._set_top_groups( query )
+
+            return self._top_groups_helper.interval_pandas_df( interval, refetch )
+
+        cache = get_result_cache()
+
+        if ( cache is None ):
+            df = self._fetch_interval_df( interval )
 
-        if ( self._group_by ):
-            query.groupby( **self._query_args )
         else:
-            query.timeseries( **self._query_args )
+            fetched = []
+            def fetch( fetch_interval ):
+                fetched.append( fetch_interval )
+                return self._fetch_interval_df( fetch_interval )
+
+            df = cache.pandas_df(
+                self.cache_key(),
+                interval,
+                self._query_args[ 'granularity' ],
+                fetch,
+                refetch
+            )
+
+            self._stats.add_count( 'cache_misses' if fetched else 'cache_hits' )
+
+        return self._finish_df( df )
+
+
+    async def pandas_df_async( self ):
+        """Awaitable counterpart of pandas_df(), which doesn't block the event loop
+        while waiting for Druid. The result cache is not used. Chunks of sharded queries
+        are fetched concurrently."""
+        if ( self._top_groups ):
+            if ( self._top_groups_helper is None ):
+                client = py_d_util.get_py_druid_query()
+                method, args = self._top_groups_query_args()
+                query = await client.post_async(
+                    getattr( client.query_builder, method )( args ) )
+                self._set_top_groups( query )
+
+            return await self._top_groups_helper.pandas_df_async()
 
-        return query.export_pandas()
+        interval = self._query_args[ 'intervals' ]
+
+        if ( not self._shard_by ):
+            df = await self._fetch_df_async( interval )
+
+        else:
+            chunk_dfs = await asyncio.gather( *[
+                self._fetch_chunk_df_async( intervals.format_interval( start, end ) )
+                for start, end in intervals.split_interval( interval, self._shard_by )
+            ] )
+
+            chunk_dfs = [ df for df in chunk_dfs if len( df ) > 0 ]
+            if ( len( chunk_dfs ) == 0 ):
+                df = pandas.DataFrame()
+            else:
+                df = pandas.concat( chunk_dfs, ignore_index = True, sort = False )
+
+        return self._finish_df( df )
+
+
+    def set_interval( self, interval ):
+        """Change the interval of this query.
+
+        :param str interval: ISO-8601 interval.
+        """
+        self._query_args[ 'intervals' ] = interval
+
+        if ( self._shard_by ):
+            self._validate_shard_by( self._shard_by )
+
+        # Top groups already found are kept
+        if ( self._top_groups_helper is not None ):
+            self._top_groups_helper.set_interval( interval )
+
+
+    def filter_json( self ):
+        """Return the query's normalized filter in Druid's JSON form, or None if it has
+        no filter."""
+        if ( 'filter' not in self._query_args ):
+            return None
+
+        return Filter.build_filter( self._query_args[ 'filter' ] )
 
 
     def json_for_query( self ):
+        if ( self._top_groups ):
+            method, args = self._top_groups_query_args()
+            return 'Top groups:\n{0}\n\nResults, filtered for top groups:\n{1}'.format(
+                json.dumps( getattr( QueryBuilder(), method )( args ).query_dict,
+                    indent = 4 ),
+                json.dumps( self._query_dict(), indent = 4 )
+            )
+
+        return json.dumps( self._query_dict(), indent = 4 )
+
+
+    def cache_key( self ):
+        """Return a key that identifies this query and the backend it's run on (see
+        py_druid_util.backend_key()), not including its interval."""
+        query_dict = self._query_dict()
+        query_dict.pop( 'intervals', None )
+        return DruidHelper.canonical_hash( {
+            'query': query_dict,
+            'backend': py_d_util.backend_key()
+        } )
+
+
+    def query_key( self ):
+        """Return a key that identifies this query and the form of its results. Helpers
+        with the same key return the same dataframe."""
+        return DruidHelper.canonical_hash( {
+            'query': self._query_dict(),
+            'compact_dtypes': self._compact_dtypes,
+            'top_groups': self._top_groups
+        } )
+
+
+    @staticmethod
+    def canonical_hash( obj ):
+        """Return a hash of the canonical JSON form of obj."""
+        canonical_json = json.dumps( obj, sort_keys = True, separators = ( ',', ':' ) )
+        return hashlib.sha1( canonical_json.encode( 'utf-8' ) ).hexdigest()
+
+
+    def _top_groups_query_args( self ):
+        # Find the top groups over the whole interval. For a single dimension, a topN
+        # query is cheapest. For several, a groupBy query with a limit is needed. Returns
+        # a tuple with the name of the pydruid method and its arguments.
+        dimensions = self._query_args[ 'dimensions' ]
+        metric = next( iter( self._query_args[ 'aggregations' ] ) )
+
+        args = {
+            'datasource': self._query_args[ 'datasource' ],
+            'granularity': 'all',
+            'intervals': self._query_args[ 'intervals' ],
+            'aggregations': self._query_args[ 'aggregations' ]
+        }
+
+        if ( 'filter' in self._query_args ):
+            args[ 'filter' ] = self._query_args[ 'filter' ]
+
+        if ( len( dimensions ) == 1 ):
+            args.update( {
+                'dimension': dimensions[0],
+                'metric': metric,
+                'threshold': self._top_groups
+            } )
+
+            return ( 'topn', args )
+
+        args.update( {
+            'dimensions': dimensions,
+            'limit_spec': {
+                'type': 'default',
+                'limit': self._top_groups,
+                'columns': [ {
+                    'dimension': metric,
+                    'direction': 'descending',
+                    'dimensionOrder': 'numeric'
+                } ]
+            }
+        } )
+
+        return ( 'groupby', args )
+
+
+    def _set_top_groups( self, query ):
+        # Set up a helper to fetch results for the top groups returned by query
+        self._record_response( query )
+        dimensions = self._query_args[ 'dimensions' ]
+        top_df = frame_for_query( query )
+
+        group_filters = [
+            DruidHelper.and_or_single_filter( [
+                Filter( dimension = dimension, value = value )
+                for dimension, value in zip( dimensions, row )
+            ] )
+            for row in ( top_df[ dimensions ].itertuples( index = False, name = None )
+                if len( top_df ) > 0 else [] )
+        ]
+
+        if ( len( group_filters ) == 0 ):
+            # No data, so no groups. This filter matches nothing.
+            group_filters = [ Filter( type = 'in', dimension = dimensions[0],
+                values = [] ) ]
+
+        filters = [ DruidHelper.or_or_single_filter( group_filters ) ]
+        if ( 'filter' in self._query_args ):
+            filters.insert( 0, self._query_args[ 'filter' ] )
+
+        query_args = dict( self._query_args,
+            filter = DruidHelper.and_or_single_filter( filters ) )
+        del query_args[ 'dimensions' ]
+
+        self._top_groups_helper = DruidHelper( query_args, dimensions, self._shard_by,
+            self._compact_dtypes, self._stats )
+
+
+    def _finish_df( self, df ):
+        with self._stats.timer( 'dtypes' ):
+            df = self._set_dtypes( df )
+
+        self._stats.add_count( 'rows', len( df ) )
+        return df
+
+
+    def _set_dtypes( self, df ):
+        # Dtypes are set after results from cache and chunks are put together, since
+        # concatenating Categoricals with different categories makes object columns.
+        if ( len( df ) == 0 ):
+            return df
+
+        df[ 'timestamp' ] = df[ 'timestamp' ].astype( 'datetime64[ns, UTC]' )
+
+        if ( not self._compact_dtypes ):
+            return df
+
+        for col in self._query_args.get( 'dimensions', [] ):
+            df[ col ] = df[ col ].astype( 'category' )
+
+        for name, aggregator in self._query_args[ 'aggregations' ].items():
+            if (
+                ( aggregator.get( 'type' ) in DruidHelper.INTEGER_AGGREGATOR_TYPES ) and
+                ( not df[ name ].isnull().any() )
+            ):
+                df[ name ] = df[ name ].astype( 'int64' )
+
+        return df
+
+
+    def _fetch_interval_df( self, interval ):
+        if ( not self._shard_by ):
+            return self._fetch_df( interval )
+
+        chunks = [
+            intervals.format_interval( chunk_start, chunk_end )
+            for chunk_start, chunk_end in
+            intervals.split_interval( interval, self._shard_by )
+        ]
+
+        with ThreadPoolExecutor(
+            max_workers = cna.config[ 'druid' ].get( 'shard_workers', 4 ) ) as executor:
+            chunk_dfs = list( executor.map( self._fetch_chunk_df, chunks ) )
+
+        # Chunks are consecutive and Druid returns rows in timestamp order, so
+        # concatenating chunks in order keeps rows in timestamp order
+        chunk_dfs = [ df for df in chunk_dfs if len( df ) > 0 ]
+        if ( len( chunk_dfs ) == 0 ):
+            return pandas.DataFrame()
+
+        return pandas.concat( chunk_dfs, ignore_index = True, sort = False )
+
+
+    def _fetch_chunk_df( self, interval ):
+        retries = self._chunk_retries()
+        attempt = 0
+
+        while True:
+            try:
+                return self._fetch_df( interval )
+            except py_d_util.DruidHTTPError:
+                raise
+            except py_d_util.RETRYABLE_ERRORS:
+                if ( attempt >= retries ):
+                    raise
+
+                time.sleep( random.uniform( 0, 2 ** attempt ) )
+                attempt += 1
+                self._stats.add_count( 'retries' )
+
+
+    async def _fetch_chunk_df_async( self, interval ):
+        retries = self._chunk_retries()
+        attempt = 0
+
+        while True:
+            try:
+                return await self._fetch_df_async( interval )
+            except py_d_util.DruidHTTPError:
+                raise
+            except py_d_util.async_retryable_errors():
+                if ( attempt >= retries ):
+                    raise
+
+                await asyncio.sleep( random.uniform( 0, 2 ** attempt ) )
+                attempt += 1
+                self._stats.add_count( 'retries' )
+
+
+    def _chunk_retries( self ):
+        # Chunks are only retried here if the client doesn't retry requests itself, so
+        # that retries don't multiply. HTTP error responses are never retried here:
+        # the client retries 5xx responses, and 4xx responses would fail again.
+        retry_policy = getattr( py_d_util.get_py_druid_query(), 'retry_policy', None )
+        if ( ( retry_policy is not None ) and ( retry_policy.retries > 0 ) ):
+            return 0
+
+        return cna.config[ 'druid' ].get( 'shard_retries', 2 )
+
+
+    def _validate_shard_by( self, shard_by ):
+        granularity = self._query_args[ 'granularity' ]
+        if ( intervals.bucket_size( granularity ) is None ):
+            raise ValueError(
+                'Sharding not available for granularity {0}.'.format( granularity ) )
+
+        # Each chunk must start at a bucket boundary, so that no bucket is split
+        # between chunks
+        for chunk_start, chunk_end in intervals.split_interval(
+            self._query_args[ 'intervals' ], shard_by ):
+
+            if ( not intervals.is_bucket_aligned( chunk_start, granularity ) ):
+                raise ValueError(
+                    'Shards of {0} are not aligned to {1} buckets.'.format(
+                        shard_by, granularity ) )
+
+
+    def _fetch_df( self, interval ):
+        # Get a configured client query object. It's shared among threads, so use the
+        # query object it returns, rather than the client's own last_query.
+        client = py_d_util.get_py_druid_query()
+        query_args = dict( self._query_args, intervals = interval )
+
+        if ( self._group_by ):
+            query = client.groupby( **query_args )
+        else:
+            query = client.timeseries( **query_args )
+
+        self._record_response( query )
+
+        # Build the dataframe column by column, rather than with pydruid's
+        # export_pandas(), which makes a dict for every row
+        with self._stats.timer( 'frame' ):
+            return frame_for_query( query )
+
+
+    async def _fetch_df_async( self, interval ):
+        client = py_d_util.get_py_druid_query()
+        query_args = dict( self._query_args, intervals = interval )
+
+        if ( self._group_by ):
+            query = client.query_builder.groupby( query_args )
+        else:
+            query = client.query_builder.timeseries( query_args )
+
+        query = await client.post_async( query )
+        self._record_response( query )
+
+        with self._stats.timer( 'frame' ):
+            return frame_for_query( query )
+
+
+    def _record_response( self, query ):
+        self._stats.add_count( 'requests' )
+        self._stats.add_count( 'response_bytes', getattr( query, 'response_bytes', 0 ) )
+        self._stats.add_time( 'transfer', getattr( query, 'transfer_seconds', 0.0 ) )
+        self._stats.add_time( 'parse', getattr( query, 'parse_seconds', 0.0 ) )
+        self._stats.add_count( 'retries', getattr( query, 'retries', 0 ) )
+        self._stats.add_count( 'hedged_requests', getattr( query, 'hedged_requests', 0 ) )
+
+
+    def _query_dict( self ):
         # This query object constructs the query but does not actually send it, unlike the
-        # client query object used above.
+        # client query object used in _fetch_df().
         if ( self._group_by ):
             query = QueryBuilder().groupby( self._query_args )
         else:
             query = QueryBuilder().timeseries( self._query_args )
 
-        return json.dumps( query.query_dict, indent = 4 )
+        return query.query_dict
 
 
     @staticmethod
@@ -59,17 +481,202 @@ class DruidHelper:
 
     @staticmethod
     def build_filter( config ):
+        """Build a pydruid Filter from a config dict. Config follows the same pattern as
+        constructors for pydruid.utils.filters.Filter; see config_example.yaml.
+
+        The filter is normalized (see normalize_filter()), and memoized, so filters from
+        config.yaml are only compiled once.
+        """
+        try:
+            key = DruidHelper.canonical_hash( config )
+        except TypeError:
+            # Configs with values that can't be serialized aren't memoized
+            return DruidHelper._compile_config( config )
+
+        with DruidHelper._compiled_filters_lock:
+            compiled = DruidHelper._compiled_filters.get( key )
+
+        if ( compiled is None ):
+            compiled = DruidHelper._compile_config( config )
+            with DruidHelper._compiled_filters_lock:
+                DruidHelper._compiled_filters[ key ] = compiled
+
+        return compiled
+
+
+    @staticmethod
+    def compile_filter( druid_filter ):
+        """Return a normalized copy of a pydruid Filter, or None if the filter matches
+        everything."""
+        normalized = DruidHelper.normalize_filter( Filter.build_filter( druid_filter ) )
+
+        if ( normalized is None ):
+            return None
+
+        return DruidHelper._filter_from_json( normalized )
+
+
+    @staticmethod
+    def filter_hash( druid_filter ):
+        """Return a stable hash of a pydruid Filter. Logically identical filters that
+        normalize to the same tree have the same hash."""
+        return DruidHelper.canonical_hash(
+            DruidHelper.normalize_filter( Filter.build_filter( druid_filter ) ) )
+
+
+    @staticmethod
+    def normalize_filter( filter_json ):
+        """Normalize a filter in Druid's JSON form, so that logically identical filters
+        serialize to the same JSON.
+
+        Nested and/or filters of the same type are flattened, and their fields are
+        sorted and deduplicated. Under or filters, selector and in filters on the same
+        dimension are merged into a single in filter. In filter values are sorted and
+        deduplicated. And/or filters with a single field, and in filters with a single
+        value, are collapsed, and double negations are removed. Returns None for a
+        filter that matches everything (an and filter with no fields).
+        """
+        filter_type = filter_json.get( 'type', 'selector' )
+
+        if ( filter_type in ( 'and', 'or' ) ):
+            fields = []
+            for field in filter_json[ 'fields' ]:
+                field = DruidHelper.normalize_filter( field )
+
+                if ( field is None ):
+                    # A field that matches everything makes an or filter match everything,
+                    # and can be dropped from an and filter
+                    if ( filter_type == 'or' ):
+                        return None
+
+                elif ( field[ 'type' ] == filter_type ):
+                    fields.extend( field[ 'fields' ] )
+
+                else:
+                    fields.append( field )
+
+            if ( filter_type == 'or' ):
+                fields = DruidHelper._merge_value_filters( fields )
+
+            fields_by_json = {
+                json.dumps( f, sort_keys = True, separators = ( ',', ':' ) ): f
+                for f in fields
+            }
+            fields = [ fields_by_json[ k ] for k in sorted( fields_by_json ) ]
+
+            if ( len( fields ) == 0 ):
+                return None if filter_type == 'and' else { 'type': 'or', 'fields': [] }
+
+            if ( len( fields ) == 1 ):
+                return fields[0]
+
+            return { 'type': filter_type, 'fields': fields }
+
+        if ( filter_type == 'not' ):
+            field = DruidHelper.normalize_filter( filter_json[ 'field' ] )
+
+            if ( field is None ):
+                return filter_json
+
+            if ( field[ 'type' ] == 'not' ):
+                return field[ 'field' ]
+
+            return { 'type': 'not', 'field': field }
+
+        if ( DruidHelper._is_value_filter( filter_json ) ):
+            return DruidHelper._value_filter(
+                filter_json[ 'dimension' ], DruidHelper._filter_values( filter_json ) )
+
+        return filter_json
+
+
+    @staticmethod
+    def _merge_value_filters( fields ):
+        # Merge selector and in filters on the same dimension into a single in filter
+        values_by_dimension = {}
+        merged = []
+
+        for field in fields:
+            if ( DruidHelper._is_value_filter( field ) ):
+                values_by_dimension.setdefault( field[ 'dimension' ], [] ).extend(
+                    DruidHelper._filter_values( field ) )
+            else:
+                merged.append( field )
+
+        for dimension, values in values_by_dimension.items():
+            merged.append( DruidHelper._value_filter( dimension, values ) )
+
+        return merged
+
+
+    @staticmethod
+    def _is_value_filter( filter_json ):
+        # Plain selector and in filters, without extraction functions or other options
+        filter_type = filter_json.get( 'type', 'selector' )
+        return (
+            ( ( filter_type == 'selector' ) and
+                ( set( filter_json ) <= { 'type', 'dimension', 'value' } ) ) or
+            ( ( filter_type == 'in' ) and
+                ( set( filter_json ) == { 'type', 'dimension', 'values' } ) )
+        )
+
+
+    @staticmethod
+    def _filter_values( filter_json ):
+        if ( filter_json.get( 'type', 'selector' ) == 'selector' ):
+            return [ filter_json[ 'value' ] ]
+
+        return filter_json[ 'values' ]
+
+
+    @staticmethod
+    def _value_filter( dimension, values ):
+        values = sorted( set( values ), key = lambda v: ( v is not None, str( v ) ) )
+
+        if ( len( values ) == 1 ):
+            return { 'type': 'selector', 'dimension': dimension, 'value': values[0] }
+
+        return { 'type': 'in', 'dimension': dimension, 'values': values }
+
+
+    @staticmethod
+    def _filter_from_json( filter_json ):
+        filter_type = filter_json[ 'type' ]
+
+        if ( filter_type in ( 'and', 'or' ) ):
+            return Filter( type = filter_type, fields =
+                [ DruidHelper._filter_from_json( f ) for f in filter_json[ 'fields' ] ] )
+
+        if ( filter_type == 'not' ):
+            return Filter(
+                type = 'not', field = DruidHelper._filter_from_json( filter_json[ 'field' ] ) )
+
+        # Other filters are already in Druid's JSON form, so set it directly rather than
+        # mapping it back to constructor arguments
+        druid_filter = Filter( dimension = None, value = None )
+        druid_filter.filter = { 'filter': filter_json }
+        return druid_filter
+
+
+    @staticmethod
+    def _compile_config( config ):
+        druid_filter = DruidHelper._filter_from_config( config )
+        return DruidHelper.compile_filter( druid_filter ) or druid_filter
+
+
+    @staticmethod
+    def _filter_from_config( config ):
         filter_params = config.copy()
 
         for name, val in filter_params.items():
             if ( isinstance( val, dict ) ):
-                filter_params[ name ] = DruidHelper.build_filter( val )
+                filter_params[ name ] = DruidHelper._filter_from_config( val )
 
             elif ( isinstance( val, list ) ):
-                filter_params[ name ] = []
-                for inner_config in val:
-                    filter_params[ name ].append(
-                        DruidHelper.build_filter( inner_config ) )
+                # Lists of filters (fields), as opposed to lists of values
+                filter_params[ name ] = [
+                    DruidHelper._filter_from_config( v ) if isinstance( v, dict ) else v
+                    for v in val
+                ]
 
         return Filter( **filter_params )
-
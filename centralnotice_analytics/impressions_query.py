@@ -3,7 +3,6 @@ from pydruid.utils.filters import Filter
 
 from centralnotice_analytics.query import Query
 from centralnotice_analytics.druid_helper import DruidHelper
-from centralnotice_analytics import TimeSeriesPlot
 
 class ImpressionsQuery( Query ):
     """A query of CentralNotice impressions for a segment of users defined by CampaignSpec.
@@ -12,46 +11,43 @@ class ImpressionsQuery( Query ):
     """
 
     def __init__( self, campaign_spec, interval, granularity = 'hour',
-            custom_filter = None, group_by_cols = None  ):
+            custom_filter = None, group_by_cols = None, shard_by = None,
+            compact_dtypes = None, top_groups = None ):
 
         super().__init__( campaign_spec, interval, granularity, custom_filter,
-            group_by_cols )
+            group_by_cols, shard_by, compact_dtypes, top_groups )
 
         self.columns_for_avg = [ 'impressions' ]
         self.columns_for_totals = [ 'impressions' ]
 
-        self._druid_helper = DruidHelper(
-            self.druid_timeseries_query_args(),
-            group_by_cols
-        )
+        with self._stats.timer( 'build_query' ):
+            self._druid_helper = DruidHelper(
+                self.druid_timeseries_query_args(),
+                group_by_cols,
+                shard_by,
+                compact_dtypes,
+                self._stats,
+                top_groups
+            )
 
 
     def _make_pandas_df( self ):
         return self._druid_helper.pandas_df()
 
 
-    def prepare_plot( self, title = None, max_group_by_values = 5 ):
-
-        if ( title is None ):
-            title = self.make_title( 'Impressions' )
-
+    def plot_spec( self ):
         if ( self._group_by_cols ):
-            flattened_df, group_columns = self.flatten_df_with_top_values(
-                'impressions', max_group_by_values )
-
-            return TimeSeriesPlot(
-                flattened_df,
-                'Impressions',
-                group_columns,
-                title = title
-            )
+            return {
+                'title': 'Impressions',
+                'left_scale_label': 'Impressions',
+                'group_column': 'impressions'
+            }
 
-        return TimeSeriesPlot(
-            self.pandas_df(),
-            'Impressions',
-            [ 'impressions' ],
-            title = title
-        )
+        return {
+            'title': 'Impressions',
+            'left_scale_label': 'Impressions',
+            'left_scale_columns': [ 'impressions' ]
+        }
 
 
     def make_query_dump(self):
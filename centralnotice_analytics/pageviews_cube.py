@@ -0,0 +1,230 @@
+import pandas
+
+import centralnotice_analytics.util.intervals as intervals
+import centralnotice_analytics.util.local_filter as local_filter
+from centralnotice_analytics.campaign_spec import CampaignSpec
+from centralnotice_analytics.pageviews_query import PageviewsQuery
+
+class PageviewsCube:
+    """Pageviews fetched once, grouped by all the dimensions that CampaignSpecs filter
+    on, to answer pageviews queries for many CampaignSpecs locally.
+
+    Filters for projects, languages, devices and countries are evaluated on the cube
+    as vectorized masks, so each query takes milliseconds and sends nothing to Druid.
+    Useful when trying out variations of a campaign's targeting.
+
+    Example:
+
+        cube = cna.PageviewsCube( '2017-12-01T00:00Z/P31D', 'hour',
+            projects = [ 'wikipedia' ], countries = [ 'CA', 'US' ] )
+
+        q = cube.pageviews_query( cna.CampaignSpec( projects = [ 'wikipedia' ],
+            languages = [ 'en' ], countries = [ 'US' ], devices = [ 'desktop' ] ) )
+
+        q.plot()
+    """
+
+    DIMENSIONS = [ 'project', 'country_code', 'access_method', 'ua_os_family',
+        'ua_device_family' ]
+    """Dimensions that pageviews in the cube are grouped by."""
+
+    def __init__( self, interval, granularity = 'hour', projects = None,
+            countries = None, shard_by = None ):
+        """
+        :param str interval: ISO-8601 interval to fetch pageviews for.
+        :param str granularity: Time bucket to aggregate data. Queries answered by the
+            cube may use this granularity or a coarser one.
+        :param list projects: Names of CentralNotice projects to fetch pageviews for.
+            (Omit for all projects.) Only CampaignSpecs targeting these projects can be
+            answered.
+        :param list countries: Country codes to fetch pageviews for. (Omit for all
+            countries.) Only CampaignSpecs targeting these countries can be answered.
+        :param str shard_by: ISO-8601 duration for splitting the interval into chunks
+            (see Query).
+
+        Pageviews are fetched with the same filters as PageviewsQuery, for all the
+        devices that CentralNotice runs on. The number of groups grows with the number
+        of projects and countries, so set those to keep the cube small.
+        """
+        self._interval = interval
+        self._granularity = granularity
+        self._projects = projects
+        self._countries = countries
+
+        self._query = PageviewsQuery(
+            CampaignSpec( projects = projects, countries = countries ),
+            interval,
+            granularity,
+            group_by_cols = PageviewsCube.DIMENSIONS,
+            shard_by = shard_by,
+            compact_dtypes = True
+        )
+
+        self._pandas_df = None
+
+
+    def pandas_df( self ):
+        """Return the cube's pageviews, fetching them if needed."""
+        if ( self._pandas_df is None ):
+            df = self._query.pandas_df()
+
+            # The cube only has pageviews by users. This column lets filters on
+            # agent_type built by PageviewsQuery be evaluated locally.
+            df = df.assign( agent_type = pandas.Categorical(
+                [ 'user' ] * len( df ), categories = [ 'user' ] ) )
+
+            self._pandas_df = df
+
+        return self._pandas_df
+
+
+    def stats( self ):
+        """Return stats for fetching the cube (see Query.stats())."""
+        return self._query.stats()
+
+
+    def make_query_dump( self ):
+        return self._query.make_query_dump()
+
+
+    def pageviews_query( self, campaign_spec, interval = None, granularity = None,
+            custom_filter = None, group_by_cols = None ):
+        """Return a PageviewsQuery with results worked out from the cube, without
+        querying Druid.
+
+        :param centralnotice_analytics.campaign_spec.CampaignSpec campaign_spec:
+            CentralNotice campaign specification. Its projects and countries must be
+            included in those of the cube.
+        :param str interval: ISO-8601 interval within the cube's interval, aligned to
+            the cube's buckets. Defaults to the cube's interval.
+        :param str granularity: Time bucket to aggregate data. Defaults to the cube's
+            granularity.
+        :param dict custom_filter: Custom filter (see Query), on the cube's dimensions.
+        :param list group_by_cols: Columns for grouping, among the cube's dimensions.
+        """
+        interval = interval or self._interval
+        granularity = granularity or self._granularity
+
+        self._validate_spec( campaign_spec )
+        self._validate_granularity( granularity )
+        start, end = self._validate_interval( interval )
+
+        for col in ( group_by_cols or [] ):
+            if ( col not in PageviewsCube.DIMENSIONS ):
+                raise ValueError( 'Column "{0}" not in cube.'.format( col ) )
+
+        query = PageviewsQuery( campaign_spec, interval, granularity, custom_filter,
+            group_by_cols )
+
+        query.set_pandas_df( self._answer( query._druid_helper.filter_json(), start, end,
+            granularity, group_by_cols or [] ) )
+
+        return query
+
+
+    def _answer( self, filter_json, start, end, granularity, group_by_cols ):
+        df = self.pandas_df()
+
+        if ( filter_json is not None ):
+            missing = local_filter.filter_dimensions( filter_json ) - set( df.columns )
+            if ( missing ):
+                raise ValueError( 'Filter uses dimensions not in cube: {0}.'.format(
+                    ', '.join( sorted( missing ) ) ) )
+
+        in_interval = ( ( df[ 'timestamp' ] >= start ) & ( df[ 'timestamp' ] < end ) )
+        if ( not in_interval.all() ):
+            df = df[ in_interval ]
+
+        if ( filter_json is None ):
+            mask = slice( None )
+        else:
+            mask = local_filter.evaluate( filter_json, df )
+
+        df = df[ [ 'timestamp', 'pageviews' ] + group_by_cols ]
+
+        if ( granularity != self._granularity ):
+            df = df.assign( timestamp = intervals.local_bucket_starts(
+                df[ 'timestamp' ], granularity ) )
+
+        # Like Druid timeseries queries, ungrouped results have a row for each bucket
+        # with data, even if no pageviews match
+        buckets = pandas.Index( df[ 'timestamp' ].unique() ).sort_values()
+
+        # As from Druid, null dimension values make their own groups
+        result = (
+            df[ mask ]
+            .groupby( [ 'timestamp' ] + group_by_cols, observed = True, sort = True,
+                dropna = False )
+            [ 'pageviews' ]
+            .sum()
+            .reset_index()
+        )
+
+        if ( not group_by_cols ):
+            result = result.set_index( 'timestamp' ).reindex( buckets, fill_value = 0.0 )
+            result = result.rename_axis( 'timestamp' ).reset_index()
+
+        for col in group_by_cols:
+            result[ col ] = result[ col ].cat.remove_unused_categories()
+
+        # Same column order as results from Druid
+        return result[ group_by_cols + [ 'pageviews', 'timestamp' ] ]
+
+
+    def _validate_spec( self, campaign_spec ):
+        for name, cube_values, spec_values in (
+            ( 'projects', self._projects, campaign_spec.projects ),
+            ( 'countries', self._countries, campaign_spec.countries )
+        ):
+            if ( cube_values is None ):
+                continue
+
+            if ( spec_values is None ):
+                raise ValueError(
+                    'Cube only includes some {0}; CampaignSpec needs all.'.format( name ) )
+
+            outside = set( spec_values ) - set( cube_values )
+            if ( outside ):
+                raise ValueError( 'Cube does not include {0} {1}.'.format(
+                    name, ', '.join( sorted( outside ) ) ) )
+
+
+    def _validate_granularity( self, granularity ):
+        if ( granularity == self._granularity ):
+            return
+
+        # Cube buckets must fit exactly in buckets of the requested granularity
+        cube_size = intervals.bucket_size( self._granularity )
+        size = intervals.bucket_size( granularity )
+        day = intervals.BUCKET_SIZES[ 'day' ]
+
+        if (
+            ( cube_size is None ) or ( day % cube_size != pandas.Timedelta( 0 ) ) or
+            ( ( granularity not in ( 'week', 'month' ) ) and (
+                ( size is None ) or ( size % cube_size != pandas.Timedelta( 0 ) ) ) )
+        ):
+            raise ValueError( 'Granularity {0} not available from {1} cube.'.format(
+                granularity, self._granularity ) )
+
+
+    def _validate_interval( self, interval ):
+        start, end = intervals.parse_interval( interval )
+        cube_start, cube_end = intervals.parse_interval( self._interval )
+
+        if ( ( start < cube_start ) or ( end > cube_end ) ):
+            raise ValueError( 'Interval {0} is not within cube interval {1}.'.format(
+                interval, self._interval ) )
+
+        if ( intervals.bucket_size( self._granularity ) is None ):
+            if ( ( start, end ) != ( cube_start, cube_end ) ):
+                raise ValueError( ( 'Cube with granularity {0} only has results ' +
+                    'for its whole interval.' ).format( self._granularity ) )
+
+        elif ( not (
+            intervals.is_bucket_aligned( start, self._granularity ) and
+            intervals.is_bucket_aligned( end, self._granularity )
+        ) ):
+            raise ValueError( 'Interval {0} is not aligned to {1} buckets.'.format(
+                interval, self._granularity ) )
+
+        return ( start, end )
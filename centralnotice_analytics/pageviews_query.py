@@ -4,7 +4,7 @@ from pydruid.utils.filters import Filter
 import centralnotice_analytics as cna
 from centralnotice_analytics.query import Query
 from centralnotice_analytics.druid_helper import DruidHelper
-from centralnotice_analytics import TimeSeriesPlot
+from centralnotice_analytics.project_index import get_project_index
 
 class PageviewsQuery( Query ):
     """A query of pageviews for a segment of users defined by CampaignSpec.
@@ -13,10 +13,11 @@ class PageviewsQuery( Query ):
     """
 
     def __init__( self,  campaign_spec, interval, granularity = 'hour',
-            custom_filter = None, group_by_cols = None ):
+            custom_filter = None, group_by_cols = None, shard_by = None,
+            compact_dtypes = None, top_groups = None ):
 
         super().__init__( campaign_spec, interval, granularity, custom_filter,
-            group_by_cols )
+            group_by_cols, shard_by, compact_dtypes, top_groups )
 
         self.columns_for_avg = [ 'pageviews' ]
         self.columns_for_totals = [ 'pageviews' ]
@@ -32,38 +33,34 @@ class PageviewsQuery( Query ):
             self.warnings.append( 'Device filtering can be inaccurate, since device ' +
                 'detection in CN and in server log processing may differ.' )
 
-        self._druid_helper = DruidHelper(
-            self.druid_timeseries_query_args(),
-            group_by_cols
-        )
+        with self._stats.timer( 'build_query' ):
+            self._druid_helper = DruidHelper(
+                self.druid_timeseries_query_args(),
+                group_by_cols,
+                shard_by,
+                compact_dtypes,
+                self._stats,
+                top_groups
+            )
 
 
     def _make_pandas_df( self ):
         return self._druid_helper.pandas_df()
 
 
-    def prepare_plot( self, title = None, max_group_by_values = 5 ):
-
-        if ( title is None ):
-            title = self.make_title( 'Pageviews' )
-
+    def plot_spec( self ):
         if ( self._group_by_cols ):
-            flattened_df, group_columns = self.flatten_df_with_top_values(
-                'pageviews', max_group_by_values )
-
-            return TimeSeriesPlot(
-                flattened_df,
-                'Pageviews',
-                group_columns,
-                title = title
-            )
+            return {
+                'title': 'Pageviews',
+                'left_scale_label': 'Pageviews',
+                'group_column': 'pageviews'
+            }
 
-        return TimeSeriesPlot(
-            self.pandas_df(),
-            'Pageviews',
-            [ 'pageviews' ],
-            title = title
-        )
+        return {
+            'title': 'Pageviews',
+            'left_scale_label': 'Pageviews',
+            'left_scale_columns': [ 'pageviews' ]
+        }
 
 
     def make_query_dump( self ):
@@ -101,14 +98,31 @@ class PageviewsQuery( Query ):
 
 
     def proj_lang_druid_filter( self ):
+        # Escape '.' in URL patterns used in Druid regex filters
+        patterns = list(
+            map( lambda p: p.replace( '.', r'\.' ), self._proj_lang_url_strs ) )
+
+        # If available, use the project index to resolve patterns to exact project
+        # values, which are much cheaper for Druid to filter than regexes
+        index = get_project_index()
+        if ( index is not None ):
+            projects = index.match( patterns )
+            if ( len( projects ) > 0 ):
+                warning = ( 'Projects are filtered using the local project index. ' +
+                    'Wikis added since the index was updated are not included.' )
+
+                if ( warning not in self.warnings ):
+                    self.warnings.append( warning )
+
+                return Filter( type = 'in', dimension = 'project', values = projects )
+
         filters = []
 
-        # Escape '.' in URL patterns used in Druid regex filters
-        for url_str in map( lambda p: p.replace( '.', '\.' ), self._proj_lang_url_strs ):
+        for pattern in patterns:
             druid_filter = Filter(
                 type = 'regex',
                 dimension = 'project',
-                pattern = url_str
+                pattern = pattern
             )
             filters.append( druid_filter )
 
@@ -0,0 +1,133 @@
+import http.client, os, re, threading, time, warnings
+
+import pandas
+from pydruid.utils.aggregators import doublesum
+
+import centralnotice_analytics as cna
+import centralnotice_analytics.util.intervals as intervals
+from centralnotice_analytics.druid_helper import DruidHelper
+from centralnotice_analytics.util.files import atomic_write
+
+project_index = None
+"""ProjectIndex object, set up as per config.yaml"""
+
+_project_index_lock = threading.Lock()
+
+_failed_until = None
+"""Time before which loading the index is not retried, after it failed to load."""
+
+RETRY_AFTER_SECONDS = 600
+"""Seconds to wait before trying to load the index again, after it failed to load."""
+
+class ProjectIndex:
+    """An index of the values of the project dimension in pageviews_hourly.
+
+    Used to resolve project and language specifications to exact project values, so
+    they can be filtered with a single in filter rather than many regex filters.
+    """
+
+    def __init__( self, projects ):
+        """
+        :param list projects: Values of the project dimension (for example,
+            'en.wikipedia').
+        """
+        self._projects = sorted( set( projects ) )
+
+
+    def projects( self ):
+        return list( self._projects )
+
+
+    def match( self, patterns ):
+        """Return the sorted list of projects that match any of a list of regular
+        expressions. Like Druid regex filters, patterns are unanchored."""
+        combined = re.compile( '|'.join( '(?:{0})'.format( p ) for p in patterns ) )
+        return [ p for p in self._projects if combined.search( p ) ]
+
+
+    def save( self, filename ):
+        """Save the index to a file with one project per line."""
+        with atomic_write( filename, 'w' ) as stream:
+            stream.write( '\n'.join( self._projects ) + '\n' )
+
+
+    @staticmethod
+    def from_file( filename ):
+        """Load an index from a file with one project per line."""
+        with open( filename, 'r' ) as stream:
+            return ProjectIndex( line.strip() for line in stream if line.strip() )
+
+
+    @staticmethod
+    def from_druid( lookback_days = 30 ):
+        """Load an index from the values of the project dimension in pageviews_hourly
+        during the last lookback_days."""
+        end = pandas.Timestamp.now( tz = 'UTC' ).floor( 'h' )
+        start = end - pandas.Timedelta( days = lookback_days )
+
+        helper = DruidHelper( {
+            'datasource': 'pageviews_hourly',
+            'granularity': 'all',
+            'intervals': intervals.format_interval( start, end ),
+            'aggregations': { 'pageviews': doublesum( 'view_count' ) }
+        }, [ 'project' ] )
+
+        df = helper.pandas_df()
+        if ( len( df ) == 0 ):
+            return ProjectIndex( [] )
+
+        return ProjectIndex( df[ 'project' ].dropna().astype( str ).tolist() )
+
+
+def get_project_index():
+    """Return the ProjectIndex set up as per config.yaml, or None if the index is not
+    enabled or could not be loaded.
+
+    The index is read from the configured file. If the file doesn't exist, or is older
+    than max_age_days, the index is loaded from Druid and saved to the file. If
+    loading fails, it is not retried for RETRY_AFTER_SECONDS.
+    """
+    global project_index, _failed_until
+
+    if ( project_index is not None ):
+        return project_index
+
+    if ( ( _failed_until is not None ) and ( time.time() < _failed_until ) ):
+        return None
+
+    index_config = cna.config.get( 'project_index' )
+    if ( ( index_config is None ) or ( not index_config.get( 'enabled' ) ) ):
+        return None
+
+    with _project_index_lock:
+        if ( project_index is not None ):
+            return project_index
+
+        if ( ( _failed_until is not None ) and ( time.time() < _failed_until ) ):
+            return None
+
+        filename = os.path.expanduser( index_config[ 'file' ] )
+        max_age_days = index_config.get( 'max_age_days' )
+
+        try:
+            age_days = ( time.time() - os.path.getmtime( filename ) ) / 86400
+            stale = ( max_age_days is not None ) and ( age_days > max_age_days )
+        except OSError:
+            stale = True
+
+        try:
+            if ( stale ):
+                index = ProjectIndex.from_druid( index_config.get( 'lookback_days', 30 ) )
+                index.save( filename )
+            else:
+                index = ProjectIndex.from_file( filename )
+
+        except ( IOError, http.client.HTTPException ) as e:
+            warnings.warn( 'Project index not available, filtering projects with regex ' +
+                'filters: {0}'.format( e ) )
+            _failed_until = time.time() + RETRY_AFTER_SECONDS
+            return None
+
+        project_index = index
+
+    return project_index
@@ -1,12 +1,22 @@
 from abc import ABCMeta, abstractmethod
 
+import numpy
+import pandas
+
+import centralnotice_analytics as cna
+import centralnotice_analytics.query_stats as query_stats
+import centralnotice_analytics.util.intervals as intervals
+
+cna.set_display_options()
+
 class Query:
     """Abstract superclass for queries of CentralNotice-related data."""
     __metaclass__ = ABCMeta
 
 
     def __init__( self, campaign_spec, interval, granularity = 'hour',
-            custom_filter = None, group_by_cols = None ):
+            custom_filter = None, group_by_cols = None, shard_by = None,
+            compact_dtypes = None, top_groups = None, stats = None ):
         """
         :param centralnotice_analytics.campaign_spec.CampaignSpec campaign_spec:
             CentralNotice campaign specification for query.
@@ -16,6 +26,18 @@ class Query:
             Follows the same pattern as constructors for pydruid.utils.filters.Filter.
             See config_example.yaml for examples.
         :param list group_by_cols: A list of names of columns for grouping.
+        :param str shard_by: ISO-8601 duration (for example, 'P1D' or 'P1W'). If set,
+            the interval is split into chunks of this duration, which are fetched
+            concurrently and retried individually. Useful for long intervals.
+        :param bool compact_dtypes: Return group-by columns as pandas Categoricals and
+            integer counts as int64, to save memory. Defaults to True for grouped
+            queries. Timestamps are always returned as datetime64[ns, UTC].
+        :param int top_groups: For grouped queries, only fetch results for this number
+            of groups with the highest totals over the whole interval. The top groups
+            are found by Druid, so data transferred doesn't grow with the number of
+            groups. Useful when only the top groups will be plotted.
+        :param stats: QueryStats to record timings and sizes in. Defaults to a new one,
+            enabled as per config.yaml (see query_stats).
 
         Subclasses should add any warnings to self.warnings on instantiation.
         """
@@ -25,10 +47,23 @@ class Query:
         self._granularity = granularity
         self._custom_filter = custom_filter
         self._group_by_cols = group_by_cols
+        self._shard_by = shard_by
+        self._compact_dtypes = compact_dtypes
+        self._top_groups = top_groups
 
         self._pandas_df = None
         """Pandas dataframe"""
 
+        self._running_stats = None
+        """Sums and counts of non-null values of columns for totals and averages"""
+
+        self._stats = stats if ( stats is not None ) else query_stats.new_stats()
+        """Timings and sizes recorded while running the query"""
+
+        self._report_stats = True
+        """Whether to pass stats to query_stats callbacks. False for sub-queries, whose
+        stats are included in those of the query that runs them."""
+
         self.warnings = []
         """A list of strings with warnings about the query."""
 
@@ -47,80 +82,401 @@ class Query:
         if ( self._pandas_df is None ):
             self._pandas_df = self._make_pandas_df()
 
+            if ( self._stats.enabled and self._report_stats ):
+                query_stats.report( self, self.stats() )
+
+        return self._pandas_df
+
+
+    async def pandas_df_async( self ):
+        """Awaitable counterpart of pandas_df(), for use in asyncio code (such as
+        Jupyter notebooks). Druid queries are sent without blocking the event loop, so
+        many queries can be in flight at once. Requires aiohttp."""
+        if ( self._pandas_df is None ):
+            self._pandas_df = await self._make_pandas_df_async()
+
+            if ( self._stats.enabled and self._report_stats ):
+                query_stats.report( self, self.stats() )
+
         return self._pandas_df
 
 
+    def set_pandas_df( self, pandas_df ):
+        """Use results fetched elsewhere (for example, by a QueryBatch) as the results
+        of this query."""
+        self._pandas_df = pandas_df
+        self._running_stats = None
+
+
+    def has_pandas_df( self ):
+        return self._pandas_df is not None
+
+
+    def stats( self ):
+        """Return a dict with timings and sizes recorded while running this query, or
+        None if stats are not enabled.
+
+        Timings (in seconds) are in a 'phases' dict, with keys such as 'build_query',
+        'transfer', 'parse', 'frame', 'dtypes' and 'plot'. Counts include 'requests',
+        'response_bytes', 'rows', 'cache_hits', 'cache_misses', 'retries' and
+        'hedged_requests' (duplicates sent for slow requests). Stats are enabled
+        in config.yaml, or with centralnotice_analytics.query_stats.enable().
+        """
+        return self._stats.as_dict()
+
+
+    def leaf_queries( self ):
+        """Return the queries that each send a single query to Druid, and whose results
+        make up the results of this query. By default, that's just this query."""
+        return [ self ]
+
+
+    def query_key( self ):
+        """Return a key that identifies the Druid query sent by this query. Queries with
+        the same key get the same results."""
+        return self._druid_helper.query_key()
+
+
+    def split_by_group( self ):
+        """Return a dict of dataframes with the results for each group of a grouped
+        query, by the value of the group-by column (or a tuple of values, if there are
+        several group-by columns). Group-by columns are dropped from the dataframes."""
+        if ( not self._group_by_cols ):
+            raise ValueError( 'Query is not grouped.' )
+
+        df = self.pandas_df()
+        group_cols = self._group_by_cols
+        by = group_cols[ 0 ] if ( len( group_cols ) == 1 ) else group_cols
+
+        return {
+            key: group_df.drop( columns = group_cols ).reset_index( drop = True )
+            for key, group_df in df.groupby( by, observed = True, sort = False )
+        }
+
+
     def totals( self ):
-        return self.pandas_df()[ self.columns_for_totals ].sum()
+        sums, counts = self._get_running_stats()
+        return sums[ self.columns_for_totals ]
 
 
     def averages( self ):
-        return self.pandas_df()[ self.columns_for_avg ].mean()
+        sums, counts = self._get_running_stats()
+        return sums[ self.columns_for_avg ] / counts[ self.columns_for_avg ]
+
+
+    def refresh( self, end = None, overlap = 'PT2H' ):
+        """Update results for a campaign that is still running, by fetching only
+        buckets that were incomplete or not yet available when results were last
+        fetched. The end of the query's interval is moved to the new end.
+
+        Buckets in a short window before the last complete bucket are fetched again too,
+        to pick up data that arrived late. These buckets are always fetched from Druid,
+        even if they're in the result cache. Totals and averages are updated
+        incrementally.
+
+        :param str end: ISO-8601 timestamp for the new end of the interval. Defaults to
+            the start of the current bucket, so that only buckets that have ended are
+            included.
+        :param str overlap: ISO-8601 duration of the window of complete buckets to fetch
+            again.
+        :return: The updated Pandas dataframe.
+        """
+        if ( intervals.bucket_size( self._granularity ) is None ):
+            raise ValueError(
+                'Refresh not available for granularity {0}.'.format( self._granularity ) )
+
+        start, previous_end = intervals.parse_interval( self._interval )
+
+        if ( end is None ):
+            # An end aligned to buckets lets the result cache store results by bucket
+            end = max( previous_end, intervals.bucket_floor(
+                pandas.Timestamp.now( tz = 'UTC' ), self._granularity ) )
+        else:
+            end = intervals.parse_timestamp( end )
+
+        if ( end < previous_end ):
+            raise ValueError( 'New end of interval is before the current end.' )
+
+        new_interval = intervals.format_interval( start, end )
+
+        if ( self._pandas_df is None ):
+            self._set_interval( new_interval )
+            return self.pandas_df()
+
+        # Buckets that started before the previous end of the interval may have been
+        # incomplete, so fetch from the last bucket fetched, less the overlap window
+        refetch_start = max( start, intervals.bucket_floor(
+            previous_end - intervals.parse_duration( overlap ), self._granularity ) )
+
+        increment_df = self._fetch_increment_df(
+            intervals.format_interval( refetch_start, end ) )
+
+        df = self._pandas_df
+        if ( len( df ) > 0 ):
+            replaced = df[ 'timestamp' ] >= refetch_start
+            kept_df = df[ ~replaced ]
+            replaced_df = df[ replaced ]
+        else:
+            kept_df = replaced_df = df
+
+        self._update_running_stats( replaced_df, increment_df )
+        self._pandas_df = Query._concat_results( kept_df, increment_df )
+        self._set_interval( new_interval )
+
+        return self._pandas_df
+
+
+    def _set_interval( self, interval ):
+        self._interval = interval
+        self._druid_helper.set_interval( interval )
+
+
+    def _fetch_increment_df( self, interval ):
+        """Fetch results for part of the query's interval from Druid, bypassing cached
+        results. Subclasses may override."""
+        return self._druid_helper.interval_pandas_df( interval, refetch = True )
+
+
+    def _running_stats_columns( self ):
+        return list( dict.fromkeys(
+            ( self.columns_for_totals or [] ) + ( self.columns_for_avg or [] ) ) )
+
+
+    def _get_running_stats( self ):
+        if ( self._running_stats is None ):
+            df = self.pandas_df()[ self._running_stats_columns() ]
+            self._running_stats = ( df.sum(), df.count() )
 
+        return self._running_stats
+
+
+    def _update_running_stats( self, removed_df, added_df ):
+        if ( self._running_stats is None ):
+            return
+
+        sums, counts = self._running_stats
+        columns = self._running_stats_columns()
+
+        for df, sign in ( ( removed_df, -1 ), ( added_df, 1 ) ):
+            if ( len( df ) > 0 ):
+                sums = sums + sign * df[ columns ].sum()
+                counts = counts + sign * df[ columns ].count()
+
+        # Infinite values (such as rates for buckets without pageviews) can't be
+        # subtracted, so recalculate from scratch when needed
+        if ( numpy.isfinite( sums.astype( 'float64' ) ).all() ):
+            self._running_stats = ( sums, counts )
+        else:
+            self._running_stats = None
+
+
+    @staticmethod
+    def _concat_results( df, increment_df ):
+        if ( len( increment_df ) == 0 ):
+            return df
+
+        if ( len( df ) == 0 ):
+            return increment_df
+
+        # Use the same categories on both sides, since concatenating Categoricals with
+        # different categories makes object columns
+        for col in df.columns:
+            if (
+                isinstance( df[ col ].dtype, pandas.CategoricalDtype ) and
+                isinstance( increment_df[ col ].dtype, pandas.CategoricalDtype )
+            ):
+                categories = df[ col ].cat.categories.union(
+                    increment_df[ col ].cat.categories )
+
+                df = df.assign( **{ col: df[ col ].cat.set_categories( categories ) } )
+                increment_df = increment_df.assign(
+                    **{ col: increment_df[ col ].cat.set_categories( categories ) } )
+
+        return pandas.concat( [ df, increment_df ], ignore_index = True, sort = False )
+
+
+    ROLLUP_GRANULARITIES = [ 'minute', 'fifteen_minute', 'thirty_minute', 'hour', 'day',
+        'week', 'month', 'all' ]
+    """Granularities available for rollup(), from finest to coarsest."""
+
+    def rollup( self, granularity, tz = 'UTC' ):
+        """Re-aggregate results to a coarser granularity locally, without querying
+        Druid again.
+
+        :param str granularity: Coarser granularity ('hour', 'day', 'week', 'month' or
+            'all', for totals over the whole interval).
+        :param str tz: Time zone for day, week and month buckets, which start at local
+            midnight (weeks start on Monday). Timestamps are returned in this time zone.
+            Its UTC offsets must be whole numbers of the query's buckets.
+        :return: A new Pandas dataframe, with totals for each bucket (and group, for
+            grouped queries).
+        """
+        self._validate_rollup( granularity, tz )
 
-    def flatten_df_with_top_values( self, aggregate_col, max_values ):
         df = self.pandas_df()
+        timestamps = df[ 'timestamp' ]
 
-        # Get the top max_values groups for aggregte_col values
-        top_values = (
-            df
-            .groupby( self._group_by_cols )[ [ aggregate_col ] ]
+        if ( granularity == 'all' ):
+            buckets = pandas.Series(
+                timestamps.min(), index = df.index, name = 'timestamp' ).dt.tz_convert( tz )
+        else:
+            buckets = intervals.local_bucket_starts( timestamps, granularity, tz )
+
+        keys = [ buckets ] + [ df[ col ] for col in ( self._group_by_cols or [] ) ]
+
+        rolled_up_df = (
+            df[ self._rollup_columns() ]
+            .groupby( keys, observed = True )
             .sum()
-            .sort_values( by = [ aggregate_col ], ascending = False )
-            .head( max_values )
             .reset_index()
         )
 
-        # TODO Maybe find a faster way to do this?
-        # Create a list two-column dataframes, one for each top value
-        group_dfs = []
-        for i in range( 0, len( top_values ) ):
-            group_df = df.copy()
-            group_label_parts = []
-
-            for col in self._group_by_cols:
-                val = top_values[ col ][ i ]
-                group_df = group_df[ group_df[ col ] == val ]
-                group_label_parts.append( val )
-
-            # remove unwanted columns
-            for col in group_df.columns.tolist():
-                if ( ( col == aggregate_col ) or ( col == 'timestamp' ) ):
-                    continue
-
-                group_df.drop( col, axis=1, inplace = True )
-
-            # rename the aggregate to identify the value(s) it represents
-            group_df.rename(
-                columns = { aggregate_col: ', '.join( group_label_parts ) },
-                inplace = True
-            )
-
-            group_df.set_index( 'timestamp', inplace = True )
-            group_dfs.append( group_df )
+        return self._derive_rollup_columns( rolled_up_df )
+
+
+    def _rollup_columns( self ):
+        """Columns to sum when re-aggregating results. Subclasses may override."""
+        return self.columns_for_totals
+
+
+    def _derive_rollup_columns( self, rolled_up_df ):
+        """Add columns that can't be summed to re-aggregated results. Subclasses may
+        override."""
+        return rolled_up_df
+
+
+    def _validate_rollup( self, granularity, tz ):
+        granularities = Query.ROLLUP_GRANULARITIES
+
+        if (
+            ( granularity not in granularities ) or
+            ( self._granularity not in granularities ) or
+            ( granularities.index( granularity ) <= granularities.index( self._granularity ) )
+        ):
+            raise ValueError( 'Can\'t re-aggregate {0} results by {1}.'.format(
+                self._granularity, granularity ) )
+
+        # Buckets of the new granularity must be made up of whole buckets of the
+        # original one
+        if ( granularity == 'all' ):
+            return
+
+        if (
+            ( self._granularity in [ 'week', 'month' ] ) or
+            ( ( self._granularity == 'day' ) and ( tz != 'UTC' ) )
+        ):
+            raise ValueError( 'Can\'t re-aggregate {0} results by {1} in {2}.'.format(
+                self._granularity, granularity, tz ) )
+
+        # Local bucket boundaries only fall on boundaries of the original buckets if the
+        # time zone's UTC offsets are multiples of the original bucket size. Offsets
+        # don't change more often than hourly, so checking each hour finds them all.
+        if ( tz != 'UTC' ):
+            start, end = intervals.parse_interval( self._interval )
+            utc_hours = pandas.date_range( start, end, freq = 'h' )
+            offsets = ( utc_hours.tz_convert( tz ).tz_localize( None ) -
+                utc_hours.tz_localize( None ) )
+
+            if ( ( offsets % intervals.bucket_size( self._granularity ) ).any() ):
+                raise ValueError( ( 'Can\'t re-aggregate {0} results by {1} in {2}, ' +
+                    'whose UTC offset is not a whole number of {0} buckets.' ).format(
+                    self._granularity, granularity, tz ) )
+
+
+    def flatten_df_with_top_values( self, aggregate_col, max_values, other_label = None,
+            rank_col = None ):
+        """Make a dataframe with a timestamp column and a column of aggregate_col values
+        for each of the max_values groups with the highest total rank_col.
+
+        :param str aggregate_col: Name of the column with values to flatten.
+        :param int max_values: Maximum number of groups to include.
+        :param str other_label: If set, add a column with this label, with the sum of
+            aggregate_col for all the groups not included.
+        :param str rank_col: Name of the column whose totals are used to choose the
+            top groups. Defaults to aggregate_col. Use for values that can't be summed,
+            such as rates.
+        :return: A tuple with the flattened dataframe and a list of the names of its
+            group columns. Group columns are named by joining the group's values.
+        """
+        df = self.pandas_df()
 
-        # Join using an index of all timestamps in the original dataframe
-        timestamps = df[['timestamp']].drop_duplicates().copy().set_index( 'timestamp' )
+        # Get the top max_values groups for rank_col values
+        top_groups = (
+            df
+            .groupby( self._group_by_cols, observed = True )[ rank_col or aggregate_col ]
+            .sum()
+            .sort_values( ascending = False )
+            .head( max_values )
+            .index
+        )
 
+        group_columns = [
+            ', '.join( map( str, key if isinstance( key, tuple ) else ( key, ) ) )
+            for key in top_groups
+        ]
+
+        # Find the position of each row's group among the top groups (or -1 for rows
+        # not in a top group), so all groups can be aggregated in a single pass
+        if ( len( self._group_by_cols ) == 1 ):
+            row_keys = pandas.Index( df[ self._group_by_cols[0] ] )
+        else:
+            row_keys = pandas.MultiIndex.from_frame( df[ self._group_by_cols ] )
+
+        positions = top_groups.get_indexer( row_keys )
+        values = df[ aggregate_col ]
+        timestamps = df[ 'timestamp' ]
+
+        if ( other_label is not None ):
+            positions[ positions == -1 ] = len( group_columns )
+            group_columns.append( other_label )
+
+        elif ( ( positions == -1 ).any() ):
+            in_top = positions != -1
+            positions = positions[ in_top ]
+            values = values[ in_top ]
+            timestamps = timestamps[ in_top ]
+
+        # Include all timestamps in the original dataframe, in their original order
         flattened_df = (
-            timestamps
-            .join( group_dfs )
-            .reset_index()
-            .rename( columns = { 'index': 'timestamp' } )
-            .fillna( 0 )
+            values
+            .groupby( [ timestamps, positions ] )
+            .sum()
+            .unstack( fill_value = 0 )
+            .reindex(
+                index = pandas.Index( df[ 'timestamp' ].unique(), name = 'timestamp' ),
+                columns = range( len( group_columns ) ),
+                fill_value = 0
+            )
         )
 
-        group_columns = flattened_df.columns.tolist()
-        group_columns.remove( 'timestamp' )
+        flattened_df.columns = group_columns
 
-        return ( flattened_df, group_columns )
+        return ( flattened_df.reset_index(), list( group_columns ) )
 
 
     def plot( self, title = None, max_group_by_values = 5 ):
-        plot = self.prepare_plot( title, max_group_by_values )
+        with self._stats.timer( 'plot' ):
+            plot = self.prepare_plot( title, max_group_by_values )
+
         plot.show()
 
 
+    def save_plot( self, filename, title = None, max_group_by_values = 5, format = None ):
+        """Render a plot of the results to a file (for example, a PNG or SVG image),
+        without a GUI. Safe to call from several threads at once."""
+        with self._stats.timer( 'plot' ):
+            plot = self.prepare_plot( title, max_group_by_values )
+            plot.save( filename, format = format )
+
+
+    def export( self, filename ):
+        """Write results to an Arrow IPC (Feather) file, with the query dump, warnings
+        and what's needed to plot them. Load the file with
+        centralnotice_analytics.load_query(). Requires pyarrow."""
+        from centralnotice_analytics.stored_query import export_query
+        export_query( self, filename )
+
+
     def dump_query( self ):
         print ( self.make_query_dump() )
 
@@ -133,17 +489,65 @@ class Query:
             prefix,
             self._interval,
             self._granularity,
-            self._campaign_spec.title()
+            self._campaign_title()
         )
 
 
+    def prepare_plot( self, title = None, max_group_by_values = 5 ):
+        """Make a TimeSeriesPlot of the results, as per plot_spec(). For grouped
+        queries, the max_group_by_values top groups are plotted."""
+        from centralnotice_analytics.timeseries_plot import TimeSeriesPlot
+
+        spec = self.plot_spec()
+
+        if ( title is None ):
+            title = self.make_title( spec[ 'title' ] )
+
+        if ( self._group_by_cols ):
+            flattened_df, group_columns = self.flatten_df_with_top_values(
+                spec[ 'group_column' ],
+                max_group_by_values,
+                rank_col = spec.get( 'group_rank_column' )
+            )
+
+            return TimeSeriesPlot(
+                flattened_df,
+                spec[ 'left_scale_label' ],
+                group_columns,
+                title = title
+            )
+
+        return TimeSeriesPlot(
+            self.pandas_df(),
+            spec[ 'left_scale_label' ],
+            spec[ 'left_scale_columns' ],
+            right_scale_label = spec.get( 'right_scale_label' ),
+            right_scale_columns = spec.get( 'right_scale_columns' ),
+            title = title
+        )
+
+
+    def _campaign_title( self ):
+        return self._campaign_spec.title()
+
+
     @abstractmethod
-    def prepare_plot( self, title = None, max_group_by_values = 5 ): pass
+    def plot_spec( self ):
+        """Return a dict describing how to plot results, with keys 'title' (a prefix
+        for the title), 'left_scale_label', and either 'left_scale_columns' (and
+        optionally 'right_scale_label' and 'right_scale_columns'), or, for grouped
+        queries, 'group_column' (the column to plot for each group) and optionally
+        'group_rank_column' (the column to choose top groups by)."""
+        pass
 
 
     @abstractmethod
     def make_query_dump( self ): pass
 
 
+    async def _make_pandas_df_async( self ):
+        return await self._druid_helper.pandas_df_async()
+
+
     @abstractmethod
     def _make_pandas_df( self ): pass
\ No newline at end of file
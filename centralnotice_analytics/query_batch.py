@@ -0,0 +1,65 @@
+from concurrent.futures import ThreadPoolExecutor
+
+class QueryBatch:
+    """A batch of queries whose data is fetched together.
+
+    Queries in a batch that send identical Druid queries (for example, PageviewsQuery
+    objects for RatesQuerys with the same targeting but different campaign names)
+    share a single request to Druid. Distinct Druid queries are sent concurrently.
+
+    Example:
+
+        batch = cna.QueryBatch( [ cna.RatesQuery( c, interval ) for c in specs ] )
+        dfs = batch.run()
+    """
+
+    def __init__( self, queries, max_concurrency = 4 ):
+        """
+        :param list queries: Query objects. Results are set on these objects, so after
+            run(), their pandas_df() methods return results without querying Druid.
+        :param int max_concurrency: Maximum number of Druid queries to send at once.
+        """
+        self._queries = queries
+        self._max_concurrency = max_concurrency
+
+
+    def distinct_query_count( self ):
+        """Return the number of distinct Druid queries still to be sent."""
+        return len( self._pending_leaf_queries() )
+
+
+    def run( self ):
+        """Fetch data for all queries in the batch, and return a list of their results,
+        in the same order as the queries."""
+        pending = self._pending_leaf_queries()
+
+        with ThreadPoolExecutor( max_workers = self._max_concurrency ) as executor:
+            futures = {
+                key: executor.submit( leaf_queries[0].pandas_df )
+                for key, leaf_queries in pending.items()
+            }
+
+            for key, leaf_queries in pending.items():
+                df = futures[ key ].result()
+
+                # Queries sharing results get shallow copies, so that adding or
+                # removing columns in one doesn't affect the others
+                for leaf_query in leaf_queries[ 1: ]:
+                    leaf_query.set_pandas_df( df.copy( deep = False ) )
+
+        return [ query.pandas_df() for query in self._queries ]
+
+
+    def _pending_leaf_queries( self ):
+        # Group queries without results by the Druid query they send
+        pending = {}
+        for query in self._queries:
+            for leaf_query in query.leaf_queries():
+                if ( leaf_query.has_pandas_df() ):
+                    continue
+
+                same_key = pending.setdefault( leaf_query.query_key(), [] )
+                if ( leaf_query not in same_key ):
+                    same_key.append( leaf_query )
+
+        return pending
@@ -0,0 +1,155 @@
+import threading, time
+
+import centralnotice_analytics as cna
+
+_enabled = None
+"""Whether stats are recorded. If None, set as per config.yaml on first use."""
+
+_callbacks = []
+
+
+class QueryStats:
+    """Timings and sizes recorded while running a query.
+
+    Phases are named parts of the work done for a query (for example, 'transfer' for
+    round trips to Druid, 'parse' for JSON parsing or 'frame' for building dataframes).
+    The time recorded for a phase is the total for all the times it ran, including
+    concurrent runs on different threads. Counts include 'requests',
+    'response_bytes', 'rows', 'cache_hits' and 'cache_misses'.
+    """
+
+    enabled = True
+
+    def __init__( self ):
+        self.phases = {}
+        self.counts = {}
+        self._lock = threading.Lock()
+
+
+    def timer( self, phase ):
+        """Return a context manager that adds the time spent in its block to phase."""
+        return _Timer( self, phase )
+
+
+    def add_time( self, phase, seconds ):
+        with self._lock:
+            self.phases[ phase ] = self.phases.get( phase, 0.0 ) + seconds
+
+
+    def add_count( self, name, count = 1 ):
+        with self._lock:
+            self.counts[ name ] = self.counts.get( name, 0 ) + count
+
+
+    def as_dict( self ):
+        with self._lock:
+            return dict( self.counts, phases = dict( self.phases ) )
+
+
+    @staticmethod
+    def combined( stats_list ):
+        """Return a new QueryStats with the totals of several QueryStats."""
+        combined = QueryStats()
+        for stats in stats_list:
+            if ( not stats.enabled ):
+                continue
+
+            for phase, seconds in stats.phases.items():
+                combined.add_time( phase, seconds )
+
+            for name, count in stats.counts.items():
+                combined.add_count( name, count )
+
+        return combined
+
+
+class DisabledQueryStats:
+    """Stand-in for QueryStats when stats are not enabled, which records nothing."""
+
+    enabled = False
+
+    def timer( self, phase ):
+        return _NULL_TIMER
+
+
+    def add_time( self, phase, seconds ):
+        pass
+
+
+    def add_count( self, name, count = 1 ):
+        pass
+
+
+    def as_dict( self ):
+        return None
+
+
+class _Timer:
+    __slots__ = ( '_stats', '_phase', '_start' )
+
+    def __init__( self, stats, phase ):
+        self._stats = stats
+        self._phase = phase
+
+
+    def __enter__( self ):
+        self._start = time.perf_counter()
+
+
+    def __exit__( self, *exc_info ):
+        self._stats.add_time( self._phase, time.perf_counter() - self._start )
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__( self ):
+        pass
+
+
+    def __exit__( self, *exc_info ):
+        pass
+
+
+DISABLED = DisabledQueryStats()
+_NULL_TIMER = _NullTimer()
+
+
+def enable( enabled = True ):
+    """Turn recording of stats for queries created from now on on or off, overriding
+    config.yaml."""
+    global _enabled
+    _enabled = enabled
+
+
+def is_enabled():
+    global _enabled
+
+    if ( _enabled is None ):
+        _enabled = bool( ( cna.config.get( 'stats' ) or {} ).get( 'enabled' ) )
+
+    return _enabled
+
+
+def add_callback( callback ):
+    """Call callback( query, stats ) whenever a query has fetched its results, with
+    the query object and its stats as a dict (see Query.stats()). For example, to
+    forward stats to a metrics system. Also enables stats.
+    """
+    _callbacks.append( callback )
+    enable()
+
+
+def remove_callback( callback ):
+    _callbacks.remove( callback )
+
+
+def new_stats():
+    """Return a new QueryStats, or DISABLED if stats are not enabled."""
+    return QueryStats() if is_enabled() else DISABLED
+
+
+def report( query, stats ):
+    """Pass a query and its stats (as a dict) to callbacks."""
+    for callback in list( _callbacks ):
+        callback( query, stats )
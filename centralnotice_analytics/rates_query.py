@@ -1,7 +1,16 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas
+from pydruid.utils.filters import Filter
 
+import centralnotice_analytics as cna
+import centralnotice_analytics.util.local_filter as local_filter
 from centralnotice_analytics.query import Query
-from centralnotice_analytics import PageviewsQuery, ImpressionsQuery, TimeSeriesPlot
+from centralnotice_analytics.query_stats import QueryStats
+from centralnotice_analytics.druid_helper import DruidHelper
+from centralnotice_analytics.pageviews_query import PageviewsQuery
+from centralnotice_analytics.impressions_query import ImpressionsQuery
 
 class RatesQuery( Query ):
     """A query of CentralNotice impression rates for user segment defined by a CampaignSpec.
@@ -11,30 +20,51 @@ class RatesQuery( Query ):
 
     def __init__( self, campaign_spec, interval, granularity = 'hour',
             custom_filter = None, custom_pageviews_filter = None,
-            custom_impressions_filter = None, group_by = None ):
+            custom_impressions_filter = None, group_by = None, shard_by = None ):
+        """
+        :param list group_by: Names of groups to get rates for (for example,
+            [ 'country' ]), as set up in the rates_group_by section of config.yaml.
+            Pageviews and impressions are each fetched with a single grouped query.
+            Groups that only apply to impressions, such as 'campaign', don't split
+            pageviews, so pageviews are fetched once and repeated for each group.
+            This compares all the campaigns matched by campaign_spec with a single
+            impressions query. Totals and averages are not available for these
+            groups, since they would count pageviews once for each group.
+
+        See Query for other parameters.
+        """
 
         if ( custom_filter ):
             raise ValueError( 'Custom filter not available for rates query.' )
 
-        if ( group_by ):
-            raise ValueError( 'Grouping not yet implemented for rates query.')
+        super().__init__( campaign_spec, interval, granularity, group_by_cols = group_by,
+            shard_by = shard_by )
 
-        super().__init__( campaign_spec, interval, granularity )
+        self._group_by_cols = group_by or None
+        self._set_up_groups()
 
         self._pageviews = PageviewsQuery(
             self._campaign_spec,
             self._interval,
             self._granularity,
-            custom_pageviews_filter
+            custom_pageviews_filter,
+            self._pageviews_group_cols or None,
+            shard_by = self._shard_by
         )
 
         self._impressions = ImpressionsQuery(
             self._campaign_spec,
             self._interval,
             self._granularity,
-            custom_impressions_filter
+            custom_impressions_filter,
+            self._impressions_group_cols or None,
+            shard_by = self._shard_by
         )
 
+        # Stats of sub-queries are reported with this query's
+        for query in ( self._pageviews, self._impressions ):
+            query._report_stats = False
+
         self.columns_for_avg = [ 'pageviews', 'impressions', 'difference', 'rate' ]
         self.columns_for_totals = [ 'pageviews', 'impressions', 'difference' ]
 
@@ -45,39 +75,244 @@ class RatesQuery( Query ):
 
 
     def _make_pandas_df( self ):
-        pv_df = self._pageviews.pandas_df()
-        imp_df = self._impressions.pandas_df()
+        # Fetch pageviews and impressions concurrently, since each is a blocking round
+        # trip to Druid
+        with ThreadPoolExecutor( max_workers = 2 ) as executor:
+            pv_future = executor.submit( self._pageviews.pandas_df )
+            imp_future = executor.submit( self._impressions.pandas_df )
 
-        rates_df = pandas.merge(pv_df, imp_df, how = 'left', on = [ 'timestamp' ] )
+            pv_df = pv_future.result()
+            imp_df = imp_future.result()
 
-        rates_df[ 'rate' ] = rates_df.apply(
-            lambda row: row.impressions/row.pageviews,
-            axis = 1
-        )
+        with self._stats.timer( 'merge' ):
+            return self._merge_rates( pv_df, imp_df )
 
-        rates_df[ 'difference' ] = rates_df.apply(
-            lambda row: row.pageviews - row.impressions,
-            axis = 1
+
+    async def _make_pandas_df_async( self ):
+        pv_df, imp_df = await asyncio.gather(
+            self._pageviews.pandas_df_async(),
+            self._impressions.pandas_df_async()
         )
 
+        with self._stats.timer( 'merge' ):
+            return self._merge_rates( pv_df, imp_df )
+
+
+    def _fetch_increment_df( self, interval ):
+        with ThreadPoolExecutor( max_workers = 2 ) as executor:
+            pv_future = executor.submit(
+                self._pageviews._fetch_increment_df, interval )
+            imp_future = executor.submit(
+                self._impressions._fetch_increment_df, interval )
+
+            pv_df = pv_future.result()
+            imp_df = imp_future.result()
+
+        return self._merge_rates( pv_df, imp_df )
+
+
+    def _set_interval( self, interval ):
+        self._interval = interval
+
+        # Results of sub-queries are not updated by refresh(), so they're discarded
+        for query in ( self._pageviews, self._impressions ):
+            query._set_interval( interval )
+            query.set_pandas_df( None )
+
+
+    def _set_up_groups( self ):
+        # Find the columns to group pageviews and impressions by, and how to rename
+        # them to group names
+        self._pageviews_group_cols = []
+        self._impressions_group_cols = []
+        self._pageviews_renames = {}
+        self._impressions_renames = {}
+        self._device_filters = None
+        self._shared_pageviews_groups = []
+
+        for group in ( self._group_by_cols or [] ):
+            group_config = ( cna.config.get( 'rates_group_by' ) or {} ).get( group )
+            if ( group_config is None ):
+                raise ValueError( 'Invalid group "{0}" for rates query.'.format( group ) )
+
+            self._impressions_group_cols.append( group_config[ 'impressions' ] )
+            self._impressions_renames[ group_config[ 'impressions' ] ] = group
+
+            if ( group_config.get( 'pageviews_from_device_filters' ) ):
+                # Group pageviews by all the dimensions used in device filters, and
+                # work out devices locally
+                self._device_filters = {
+                    device: Filter.build_filter( DruidHelper.build_filter( config ) )
+                    for device, config in cna.config[ 'device_filters' ].items()
+                }
+
+                self._device_group = group
+                self._pageviews_group_cols.extend( sorted( set().union( *[
+                    local_filter.filter_dimensions( f )
+                    for f in self._device_filters.values()
+                ] ) ) )
+
+            elif ( group_config.get( 'pageviews' ) ):
+                self._pageviews_group_cols.append( group_config[ 'pageviews' ] )
+                self._pageviews_renames[ group_config[ 'pageviews' ] ] = group
+
+            else:
+                # Pageviews are the same for every value of the group
+                self._shared_pageviews_groups.append( group )
+
+        self._pageviews_group_cols = list( dict.fromkeys( self._pageviews_group_cols ) )
+
+
+    def _merge_rates( self, pv_df, imp_df ):
+        if ( len( pv_df ) == 0 ):
+            return pv_df
+
+        if ( not self._group_by_cols ):
+            if ( len( imp_df ) == 0 ):
+                imp_df = pandas.DataFrame( {
+                    'timestamp': pv_df[ 'timestamp' ].iloc[ :0 ],
+                    'impressions': pandas.Series( [], dtype = 'float64' )
+                } )
+
+            rates_df = pandas.merge(pv_df, imp_df, how = 'left', on = [ 'timestamp' ] )
+            RatesQuery.add_rate_columns( rates_df )
+
+            return rates_df
+
+        pv_df = self._pageviews_by_group( pv_df )
+        imp_df = imp_df.rename( columns = self._impressions_renames )
+        keys = [ 'timestamp' ] + self._group_by_cols
+
+        # Repeat pageviews for each value of groups that don't split pageviews
+        for col in self._shared_pageviews_groups:
+            values = []
+            if ( col in imp_df.columns ):
+                values = imp_df[ col ].astype( 'category' ).cat.categories
+
+            pv_df = pv_df.merge(
+                pandas.DataFrame( { col: pandas.Categorical( values ) } ), how = 'cross' )
+
+        if ( len( imp_df ) == 0 ):
+            rates_df = pv_df.assign( impressions = 0 )
+
+        else:
+            # Give group columns the same categories on both sides, so they can be
+            # joined by integer codes
+            for col in self._group_by_cols:
+                categories = pandas.Index( pv_df[ col ].astype( 'category' ).cat.categories
+                    ).union( imp_df[ col ].astype( 'category' ).cat.categories )
+                pv_df[ col ] = pandas.Categorical( pv_df[ col ], categories = categories )
+                imp_df[ col ] = pandas.Categorical( imp_df[ col ], categories = categories )
+
+            rates_df = (
+                pv_df.set_index( keys )
+                .join( imp_df.set_index( keys )[ [ 'impressions' ] ], how = 'left' )
+                .reset_index()
+            )
+
+        RatesQuery.add_rate_columns( rates_df )
         return rates_df
 
 
-    def prepare_plot( self, title = None, max_group_by_values = 5 ):
+    def _pageviews_by_group( self, pv_df ):
+        pv_df = pv_df.rename( columns = self._pageviews_renames )
+
+        if ( self._device_filters is None ):
+            return pv_df
+
+        # Label each row with the first device whose filter it matches, and total
+        # pageviews for each device
+        pv_df[ self._device_group ] = local_filter.label_rows( pv_df, self._device_filters )
 
-        if ( title is None ):
-            title = self.make_title( 'Impression rates' )
+        pv_keys = [ 'timestamp' ] + [ col for col in self._group_by_cols
+            if col not in self._shared_pageviews_groups ]
 
-        return TimeSeriesPlot(
-            self.pandas_df(),
-            'Impressions and pageviews',
-            [ 'impressions', 'pageviews', 'difference' ],
-            right_scale_label = 'Impression rate',
-            right_scale_columns = [ 'rate' ],
-            title = title
+        return (
+            pv_df
+            .groupby( pv_keys, observed = True, sort = False )
+            [ 'pageviews' ]
+            .sum()
+            .reset_index()
         )
 
 
+    def _rollup_columns( self ):
+        return [ 'pageviews', 'impressions' ]
+
+
+    def _derive_rollup_columns( self, rolled_up_df ):
+        # Rates are recomputed from summed pageviews and impressions, not averaged
+        RatesQuery.add_rate_columns( rolled_up_df )
+        return rolled_up_df
+
+
+    def leaf_queries( self ):
+        return [ self._pageviews, self._impressions ]
+
+
+    def totals( self ):
+        self._check_running_stats()
+        return super().totals()
+
+
+    def averages( self ):
+        self._check_running_stats()
+        return super().averages()
+
+
+    def _check_running_stats( self ):
+        # Pageviews repeated for each value of a group would be counted once per value
+        if ( self._shared_pageviews_groups ):
+            raise ValueError( ( 'Totals and averages not available when grouping by ' +
+                '{0}, since pageviews are repeated for each group.' ).format(
+                ', '.join( self._shared_pageviews_groups ) ) )
+
+
+    def stats( self ):
+        """Return stats for this query, including its pageviews and impressions
+        sub-queries (see Query.stats())."""
+        if ( not self._stats.enabled ):
+            return None
+
+        return QueryStats.combined(
+            [ self._stats, self._pageviews._stats, self._impressions._stats ] ).as_dict()
+
+
+    @staticmethod
+    def add_rate_columns( rates_df ):
+        """Add rate and difference columns to a dataframe with pageviews and impressions
+        columns, using whole-column operations.
+
+        Missing impressions (from buckets with pageviews but no impressions) are set to
+        0. Buckets with no pageviews get a rate of inf, or NaN if they also have no
+        impressions.
+        """
+        rates_df[ 'impressions' ] = rates_df[ 'impressions' ].fillna( 0 ).astype( 'int64' )
+        rates_df[ 'rate' ] = rates_df[ 'impressions' ] / rates_df[ 'pageviews' ]
+        rates_df[ 'difference' ] = rates_df[ 'pageviews' ] - rates_df[ 'impressions' ]
+
+
+    def plot_spec( self ):
+        if ( self._group_by_cols ):
+            # Plot rates for the groups with the most pageviews, or, if pageviews are
+            # shared by groups, the most impressions
+            return {
+                'title': 'Impression rates',
+                'left_scale_label': 'Impression rate',
+                'group_column': 'rate',
+                'group_rank_column': 'impressions' if self._shared_pageviews_groups
+                    else 'pageviews'
+            }
+
+        return {
+            'title': 'Impression rates',
+            'left_scale_label': 'Impressions and pageviews',
+            'left_scale_columns': [ 'impressions', 'pageviews', 'difference' ],
+            'right_scale_label': 'Impression rate',
+            'right_scale_columns': [ 'rate' ]
+        }
+
+
     def make_query_dump(self):
         return """
 Pageviews:
@@ -0,0 +1,217 @@
+import hashlib, os, pickle, threading, time
+
+import pandas
+
+import centralnotice_analytics as cna
+import centralnotice_analytics.util.intervals as intervals
+from centralnotice_analytics.util.files import atomic_write
+
+FORMAT_VERSION = 2
+"""Version of the format of cached results, included in cache file names"""
+
+result_cache = None
+"""ResultCache object, set up as per config.yaml"""
+
+_result_cache_lock = threading.Lock()
+
+class ResultCache:
+    """On-disk cache of Druid query results.
+
+    Results are stored per time bucket, under a key that identifies the query without
+    its interval. A query over an interval that overlaps cached buckets only fetches
+    the buckets that are missing, and stitches them onto the cached ones.
+
+    Buckets that closed before they were fetched are never refetched. Buckets that
+    may still receive data (those ending within open_hours of the time they were
+    fetched) are refetched once they are older than ttl seconds.
+
+    Queries whose granularity doesn't have fixed-length buckets, or whose interval
+    isn't aligned to bucket boundaries, are cached as a whole, with the interval as
+    part of the key.
+    """
+
+    def __init__( self, cache_dir, open_hours = 3, ttl = 600 ):
+        """
+        :param str cache_dir: Directory for cache files. Created if it doesn't exist.
+        :param float open_hours: Number of hours before the current time during which
+            buckets may still receive data.
+        :param float ttl: Seconds after which cached open buckets are refetched.
+        """
+        self._cache_dir = os.path.expanduser( cache_dir )
+        self._open_hours = open_hours
+        self._ttl = ttl
+
+        # Queries for the same key are serialized, so concurrent queries don't fetch
+        # the same buckets twice. Queries for different keys run concurrently.
+        self._key_locks = {}
+        self._key_locks_lock = threading.Lock()
+
+        os.makedirs( self._cache_dir, exist_ok = True )
+
+
+    def pandas_df( self, key, interval, granularity, fetch, refetch = False ):
+        """Get results for interval, fetching only what isn't cached.
+
+        :param str key: Key identifying the query, without its interval.
+        :param str interval: ISO-8601 interval of the results requested.
+        :param granularity: Druid granularity of the query.
+        :param fetch: Function that takes an ISO-8601 interval and returns a Pandas
+            dataframe with results for that interval.
+        :param bool refetch: Fetch the whole interval, even if it's cached, and replace
+            cached results with the new ones.
+        """
+        with self._key_lock( key ):
+            return self._pandas_df( key, interval, granularity, fetch, refetch )
+
+
+    def _pandas_df( self, key, interval, granularity, fetch, refetch ):
+        start, end = intervals.parse_interval( interval )
+
+        if (
+            ( intervals.bucket_size( granularity ) is None ) or
+            ( not intervals.is_bucket_aligned( start, granularity ) ) or
+            ( not intervals.is_bucket_aligned( end, granularity ) )
+        ):
+            return self._whole_interval_df( key, interval, end, fetch, refetch )
+
+        entry = self._load( key ) or { 'buckets': {}, 'rows': None }
+        step = intervals.bucket_size( granularity )
+        buckets = intervals.bucket_starts( start, end, granularity )
+        now = time.time()
+
+        stale = [ b for b in buckets
+            if refetch or not self._is_fresh( entry[ 'buckets' ], b, now ) ]
+
+        for run_start, run_end in self._contiguous_runs( stale, step ):
+            fetched_df = fetch( intervals.format_interval( run_start, run_end ) )
+            self._store_run( entry, fetched_df, run_start, run_end, step, now )
+
+        if ( len( stale ) > 0 ):
+            self._save( key, entry )
+
+        rows = entry[ 'rows' ]
+        if ( rows is None ):
+            return pandas.DataFrame()
+
+        timestamps = pandas.to_datetime( rows[ 'timestamp' ], utc = True )
+        return rows[ ( timestamps >= start ) & ( timestamps < end ) ].reset_index(
+            drop = True )
+
+
+    def _whole_interval_df( self, key, interval, end, fetch, refetch ):
+        normalized_interval = intervals.format_interval(
+            *intervals.parse_interval( interval ) )
+        key = '{0}-{1}'.format(
+            key, hashlib.sha1( normalized_interval.encode( 'utf-8' ) ).hexdigest() )
+
+        entry = self._load( key )
+        now = time.time()
+
+        if (
+            ( not refetch ) and ( entry is not None ) and
+            ( entry[ 'final' ] or ( now - entry[ 'fetched_at' ] < self._ttl ) )
+        ):
+            return entry[ 'rows' ]
+
+        rows = fetch( interval )
+        self._save( key, {
+            'rows': rows,
+            'fetched_at': now,
+            'final': end <= self._open_from( now )
+        } )
+
+        return rows
+
+
+    def _key_lock( self, key ):
+        with self._key_locks_lock:
+            return self._key_locks.setdefault( key, threading.Lock() )
+
+
+    def _is_fresh( self, cached_buckets, bucket, now ):
+        cached = cached_buckets.get( bucket.value )
+        if ( cached is None ):
+            return False
+
+        fetched_at, final = cached
+        return final or ( now - fetched_at < self._ttl )
+
+
+    def _store_run( self, entry, fetched_df, run_start, run_end, step, now ):
+        open_from = self._open_from( now )
+
+        for bucket in pandas.date_range( run_start, run_end - step, freq = step ):
+            entry[ 'buckets' ][ bucket.value ] = ( now, bucket + step <= open_from )
+
+        rows = entry[ 'rows' ]
+        if ( ( rows is not None ) and ( len( rows ) > 0 ) ):
+            timestamps = pandas.to_datetime( rows[ 'timestamp' ], utc = True )
+            rows = rows[ ( timestamps < run_start ) | ( timestamps >= run_end ) ]
+
+        if ( ( fetched_df is not None ) and ( len( fetched_df ) > 0 ) ):
+            rows = pandas.concat( [ rows, fetched_df ], ignore_index = True, sort = False )
+
+        if ( rows is not None ):
+            # Stable sort, to keep Druid's ordering of rows within each bucket
+            timestamps = pandas.to_datetime( rows[ 'timestamp' ], utc = True )
+            rows = rows.iloc[ timestamps.argsort( kind = 'mergesort' ) ].reset_index(
+                drop = True )
+
+        entry[ 'rows' ] = rows
+
+
+    def _open_from( self, now ):
+        return pandas.Timestamp( now - self._open_hours * 3600, unit = 's', tz = 'UTC' )
+
+
+    def _path( self, key ):
+        return os.path.join(
+            self._cache_dir, '{0}.v{1}.pkl'.format( key, FORMAT_VERSION ) )
+
+
+    def _load( self, key ):
+        try:
+            with open( self._path( key ), 'rb' ) as stream:
+                return pickle.load( stream )
+        except ( OSError, EOFError, pickle.UnpicklingError ):
+            return None
+
+
+    def _save( self, key, entry ):
+        with atomic_write( self._path( key ) ) as stream:
+            pickle.dump( entry, stream, protocol = pickle.HIGHEST_PROTOCOL )
+
+
+    @staticmethod
+    def _contiguous_runs( buckets, step ):
+        runs = []
+        for bucket in buckets:
+            if ( ( len( runs ) > 0 ) and ( runs[ -1 ][ 1 ] == bucket ) ):
+                runs[ -1 ][ 1 ] = bucket + step
+            else:
+                runs.append( [ bucket, bucket + step ] )
+
+        return runs
+
+
+def get_result_cache():
+    """Return the ResultCache set up as per config.yaml, or None if caching is not
+    enabled."""
+    global result_cache
+
+    if ( result_cache is not None ):
+        return result_cache
+
+    cache_config = cna.config.get( 'result_cache' )
+    if ( ( cache_config is None ) or ( not cache_config.get( 'enabled' ) ) ):
+        return None
+
+    with _result_cache_lock:
+        if ( result_cache is None ):
+            result_cache = ResultCache(
+                cache_config[ 'dir' ],
+                cache_config.get( 'open_hours', 3 ),
+                cache_config.get( 'ttl', 600 )
+            )
+
+    return result_cache
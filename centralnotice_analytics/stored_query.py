@@ -0,0 +1,155 @@
+import json
+
+import centralnotice_analytics.query_stats as query_stats
+from centralnotice_analytics.query import Query
+from centralnotice_analytics.util.files import atomic_write
+
+FORMAT_VERSION = 1
+"""Version of the metadata stored with exported results."""
+
+METADATA_KEY = b'centralnotice_analytics'
+
+
+class StoredQuery( Query ):
+    """Results of a query, loaded from a file written by Query.export().
+
+    Data is never fetched from Druid. Results, warnings and the query dump are as they
+    were when exported. Methods for using results, such as plot(), totals(),
+    averages(), rollup() and flatten_df_with_top_values(), work as for the original
+    query. Create with load_query().
+    """
+
+    def __init__( self, pandas_df, metadata ):
+        """
+        :param pandas.DataFrame pandas_df: Query results.
+        :param dict metadata: Metadata stored by Query.export().
+        """
+        # Nothing is fetched, so there are no stats to record, and config.yaml isn't
+        # needed
+        super().__init__( None, metadata[ 'interval' ], metadata[ 'granularity' ],
+            group_by_cols = metadata[ 'group_by_cols' ], stats = query_stats.DISABLED )
+
+        self._pandas_df = pandas_df
+        self._metadata = metadata
+
+        self.query_class = metadata[ 'query_class' ]
+        """Name of the class of the original query."""
+
+        self.warnings = list( metadata[ 'warnings' ] )
+        self.columns_for_avg = metadata[ 'columns_for_avg' ]
+        self.columns_for_totals = metadata[ 'columns_for_totals' ]
+
+
+    def plot_spec( self ):
+        return self._metadata[ 'plot_spec' ]
+
+
+    def make_query_dump( self ):
+        return self._metadata[ 'query_dump' ]
+
+
+    def _make_pandas_df( self ):
+        return self._pandas_df
+
+
+    def leaf_queries( self ):
+        # No queries are sent to Druid, so a QueryBatch has nothing to fetch
+        return []
+
+
+    def query_key( self ):
+        raise ValueError( 'Stored query results don\'t send a Druid query.' )
+
+
+    def _campaign_title( self ):
+        return self._metadata[ 'campaign_title' ]
+
+
+    def _rollup_columns( self ):
+        return self._metadata[ 'rollup_columns' ]
+
+
+    def _derive_rollup_columns( self, rolled_up_df ):
+        if ( self.query_class == 'RatesQuery' ):
+            from centralnotice_analytics.rates_query import RatesQuery
+            RatesQuery.add_rate_columns( rolled_up_df )
+
+        return rolled_up_df
+
+
+    def _fetch_increment_df( self, interval ):
+        raise ValueError( 'Stored query results can\'t be refreshed.' )
+
+
+    def _set_interval( self, interval ):
+        raise ValueError( 'Stored query results can\'t be refreshed.' )
+
+
+def export_query( query, filename ):
+    """Write the results of a query to an Arrow IPC (Feather version 2) file, with
+    metadata for load_query(). The file is uncompressed, so it can be memory-mapped."""
+    pyarrow = import_pyarrow()
+
+    metadata = {
+        'format_version': FORMAT_VERSION,
+        'query_class': getattr( query, 'query_class', type( query ).__name__ ),
+        'interval': query._interval,
+        'granularity': query._granularity,
+        'group_by_cols': query._group_by_cols,
+        'campaign_title': query._campaign_title(),
+        'warnings': query.warnings,
+        'query_dump': query.make_query_dump(),
+        'plot_spec': query.plot_spec(),
+        'columns_for_avg': query.columns_for_avg,
+        'columns_for_totals': query.columns_for_totals,
+        'rollup_columns': query._rollup_columns()
+    }
+
+    table = pyarrow.Table.from_pandas( query.pandas_df(), preserve_index = False )
+    schema_metadata = dict( table.schema.metadata or {} )
+    schema_metadata[ METADATA_KEY ] = json.dumps( metadata ).encode( 'utf-8' )
+    table = table.replace_schema_metadata( schema_metadata )
+
+    with atomic_write( filename ) as stream:
+        with pyarrow.ipc.new_file( stream, table.schema ) as writer:
+            writer.write_table( table )
+
+
+def load_query( filename ):
+    """Load query results written by Query.export(), as a StoredQuery.
+
+    The file is memory-mapped, and numeric columns without nulls are used without
+    copying, so even large results load quickly. Timestamp and group-by columns are
+    converted, which copies them.
+
+    :param str filename: Name of a file written by Query.export().
+    """
+    pyarrow = import_pyarrow()
+
+    # Arrays read from the file keep the memory map open as long as they're in use
+    source = pyarrow.memory_map( filename, 'r' )
+    table = pyarrow.ipc.open_file( source ).read_all()
+
+    schema_metadata = table.schema.metadata or {}
+    if ( METADATA_KEY not in schema_metadata ):
+        raise ValueError( '{0} does not contain exported query results.'.format( filename ) )
+
+    metadata = json.loads( schema_metadata[ METADATA_KEY ].decode( 'utf-8' ) )
+    if ( metadata[ 'format_version' ] != FORMAT_VERSION ):
+        raise ValueError( 'Unsupported format version {0} in {1}.'.format(
+            metadata[ 'format_version' ], filename ) )
+
+    # With split_blocks, each column gets its own block, so columns without nulls can
+    # use the mapped memory directly
+    return StoredQuery( table.to_pandas( split_blocks = True ), metadata )
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+    except ImportError:
+        raise ImportError( 'pyarrow is required to export and load query results. ' +
+            'Install it with pip install centralnotice_analytics[export].' ) from None
+
+    return pyarrow
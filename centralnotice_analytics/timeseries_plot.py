@@ -1,60 +1,151 @@
-import matplotlib
-import matplotlib.pyplot as plt
+import io, warnings
+
+import matplotlib.dates as mdates
 import numpy as np
+import pandas
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from centralnotice_analytics.util.downsample import lttb_indices
 
 class TimeSeriesPlot:
+    """A plot of one or more columns of a dataframe with a timestamp column.
+
+    The plot is drawn on its own Figure, not through pyplot's global state, so plots
+    can be prepared and saved on several threads at once.
+    """
 
-    # TODO Does the timeseries column from Druid ever omit rows if there were no values?
+    FONT_SIZE = 14
 
     def __init__( self, pandas_df, left_scale_label,
         left_scale_columns, right_scale_label = None, right_scale_columns = None,
-        title = None, figsize = ( 20, 8 ) ):
+        title = None, figsize = ( 20, 8 ), max_points = 2000 ):
+        """
+        :param pandas.DataFrame pandas_df: Data to plot, with a timestamp column.
+        :param str left_scale_label: Label for the left y axis.
+        :param list left_scale_columns: Columns to plot on the left y axis.
+        :param str right_scale_label: Label for the right y axis, if any.
+        :param list right_scale_columns: Columns to plot on the right y axis, if any.
+        :param str title: Title for the plot.
+        :param tuple figsize: Width and height of the plot, in inches.
+        :param int max_points: Maximum number of points to plot for each column.
+            Longer series are downsampled, keeping peaks and dips. None to plot all
+            points.
+        """
+        self._args = ( pandas_df, left_scale_label, left_scale_columns,
+            right_scale_label, right_scale_columns, title, max_points )
+
+        self._figsize = figsize
+
+        self.figure = Figure( figsize = figsize )
+        """matplotlib Figure with the plot"""
+
+        FigureCanvasAgg( self.figure )
+        self._draw( self.figure, *self._args )
+
+
+    def show( self ):
+        """Show the plot, as an image if running in a notebook, or otherwise in a
+        window with pyplot."""
+        try:
+            from IPython import get_ipython
+        except ImportError:
+            get_ipython = lambda: None
+
+        ipython = get_ipython()
+
+        # Notebook kernels can't open windows, so render a PNG and display it
+        if ( getattr( ipython, 'kernel', None ) is not None ):
+            from IPython.display import display, Image
+            stream = io.BytesIO()
+            self.save( stream, format = 'png' )
+            display( Image( data = stream.getvalue(), format = 'png' ) )
+            return
+
+        # Otherwise, draw the plot again on a figure managed by pyplot, so it can be
+        # shown in a window
+        import matplotlib.pyplot as plt
+        self._draw( plt.figure( figsize = self._figsize ), *self._args )
+        plt.show()
+
+
+    def save( self, filename, format = None, dpi = None ):
+        """Render the plot to a file, without a GUI backend.
+
+        :param filename: Filename or file object to write to.
+        :param str format: File format (for example, 'png' or 'svg'). By default,
+            taken from the filename's extension.
+        :param float dpi: Resolution, in dots per inch.
+        """
+        self.figure.savefig( filename, format = format, dpi = dpi,
+            bbox_inches = 'tight' )
 
-        plt.figure( figsize = figsize )
-        matplotlib.rcParams.update( { 'font.size': 14 } )
 
-        # Figure out how to space out ticks on the x axis
-        # At this font size and dpi, we can fit about 1.5 ticks per inch
-        max_x_ticks = int( figsize[0] * 1.5 )
-        bucket_count = len( pandas_df )
-        bucket_step = 1
-        while ( bucket_count / bucket_step > max_x_ticks ):
-            bucket_step += 1
+    def pyplot_obj( self ):
+        """Deprecated. The plot is no longer drawn through pyplot; use self.figure."""
+        warnings.warn( 'TimeSeriesPlot.pyplot_obj() is deprecated. Use the figure ' +
+            'attribute instead.', DeprecationWarning )
+
+        import matplotlib.pyplot as plt
+        return plt
+
+
+    @staticmethod
+    def _draw( figure, pandas_df, left_scale_label, left_scale_columns,
+        right_scale_label, right_scale_columns, title, max_points ):
+
+        font_size = TimeSeriesPlot.FONT_SIZE
+        ax = figure.add_subplot( 1, 1, 1 )
 
-        plt.xticks(
-            np.arange( 0, bucket_count, bucket_step) ,
-            pandas_df.timestamp.tolist()[::bucket_step],
-            rotation = 'vertical'
-        )
+        # Plot against wall times in the timestamps' time zone
+        timestamps = pandas.to_datetime( pandas_df.timestamp )
+        tz = timestamps.dt.tz
+        if ( tz is not None ):
+            timestamps = timestamps.dt.tz_localize( None )
 
-        plt.xlabel( 'Time' )
-        plt.ylabel( left_scale_label )
+        x = timestamps.to_numpy()
 
-        subplots = []
-        legend_labels = []
-        bucket_count_range = range( bucket_count )
+        locator = mdates.AutoDateLocator()
+        ax.xaxis.set_major_locator( locator )
+        ax.xaxis.set_major_formatter( mdates.ConciseDateFormatter( locator ) )
 
+        ax.set_xlabel( 'Time ({0})'.format( tz ) if tz is not None else 'Time',
+            fontsize = font_size )
+        ax.set_ylabel( left_scale_label, fontsize = font_size )
+        ax.tick_params( labelsize = font_size )
+
+        lines = []
         for column in left_scale_columns:
-            subplots.append( plt.plot( bucket_count_range, pandas_df[ column ] ) )
-            legend_labels.append( column )
+            lines += TimeSeriesPlot._plot_column( ax, x, pandas_df[ column ], column,
+                max_points )
 
         if ( ( right_scale_columns ) and ( right_scale_label ) ):
-            ax2 = plt.twinx()
-            ax2.set_ylabel( right_scale_label )
+            ax2 = ax.twinx()
+            ax2.set_ylabel( right_scale_label, fontsize = font_size )
+            ax2.tick_params( labelsize = font_size )
 
+            # Continue the color cycle from the left axis
             for column in right_scale_columns:
-                subplots.append( ax2.plot( bucket_count_range, pandas_df[ column ] ) )
-                legend_labels.append( column )
+                lines += TimeSeriesPlot._plot_column( ax2, x, pandas_df[ column ], column,
+                    max_points, color = 'C{0}'.format( len( lines ) ) )
 
-        plt.legend( map( lambda p: p[0], subplots ), legend_labels )
+        ax.legend( lines, [ line.get_label() for line in lines ], fontsize = font_size )
 
         if ( title ):
-            plt.title( title )
+            ax.set_title( title, fontsize = font_size )
 
 
-    def show( self ):
-        plt.show()
+    @staticmethod
+    def _plot_column( ax, x, values, label, max_points, color = None ):
+        y = np.asarray( values, dtype = 'float64' )
 
+        # Downsample finite values, keeping the shape of the series
+        finite = np.isfinite( y )
+        x_finite = x[ finite ]
+        y_finite = y[ finite ]
 
-    def pyplot_obj( self ):
-        return plt
\ No newline at end of file
+        indices = lttb_indices( x_finite.astype( 'int64' ).astype( 'float64' ), y_finite,
+            max_points )
+
+        return ax.plot( x_finite[ indices ], y_finite[ indices ], label = label,
+            color = color )
@@ -0,0 +1,47 @@
+# Downsample time series for plotting, keeping their visual shape
+
+import numpy
+
+
+def lttb_indices( x, y, max_points ):
+    """Return the indices of up to max_points points of a series to plot, chosen with
+    the Largest-Triangle-Three-Buckets algorithm.
+
+    The first and last points are always kept. The points in between are split into
+    buckets, and from each, the point forming the largest triangle with the point kept
+    from the previous bucket and the average of the next bucket is kept. Peaks and
+    dips are kept, so the plot looks like a plot of all the points.
+
+    :param numpy.ndarray x: x values, as floats, in ascending order.
+    :param numpy.ndarray y: y values, as floats, without NaNs.
+    :param int max_points: Maximum number of points to keep (at least 3).
+    """
+    point_count = len( x )
+    if ( ( max_points is None ) or ( point_count <= max_points ) or ( max_points < 3 ) ):
+        return numpy.arange( point_count )
+
+    # Edges of buckets for all but the first and last points
+    edges = numpy.linspace( 1, point_count - 1, max_points - 1 ).astype( numpy.int64 )
+
+    indices = numpy.empty( max_points, dtype = numpy.int64 )
+    indices[ 0 ] = 0
+    indices[ -1 ] = point_count - 1
+    selected = 0
+
+    for i in range( max_points - 2 ):
+        start, end = edges[ i ], edges[ i + 1 ]
+        next_end = edges[ i + 2 ] if ( i + 2 < len( edges ) ) else point_count
+
+        next_x = x[ end:next_end ].mean()
+        next_y = y[ end:next_end ].mean()
+
+        # Twice the area of the triangle for each point in the bucket
+        areas = numpy.abs(
+            ( x[ selected ] - next_x ) * ( y[ start:end ] - y[ selected ] ) -
+            ( x[ selected ] - x[ start:end ] ) * ( next_y - y[ selected ] )
+        )
+
+        selected = start + int( numpy.argmax( areas ) )
+        indices[ i + 1 ] = selected
+
+    return indices
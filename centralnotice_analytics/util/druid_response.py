@@ -0,0 +1,84 @@
+# Build Pandas dataframes directly from parsed Druid query results
+
+import numpy
+import pandas
+
+
+def frame_from_result( result, query_type ):
+    """Make a Pandas dataframe from the parsed JSON result of a timeseries, groupBy or
+    topN query.
+
+    Values are collected into one list per column, without building an intermediate
+    object for each row. Timestamps are parsed once for each distinct value, into a
+    datetime64 column in UTC.
+
+    :param list result: Parsed JSON result, as returned by Druid.
+    :param str query_type: Druid query type ('timeseries', 'groupBy' or 'topN').
+    """
+    timestamps = []
+    columns = {}
+
+    for timestamp, values in _result_rows( result, query_type ):
+        row_index = len( timestamps )
+        timestamps.append( timestamp )
+        new_column = False
+
+        for name, value in values.items():
+            column = columns.get( name )
+            if ( column is None ):
+                # Backfill columns that first appear after the first row
+                column = columns[ name ] = [ None ] * row_index
+                new_column = True
+
+            column.append( value )
+
+        # Fill in columns missing from this row
+        if ( new_column or ( len( values ) != len( columns ) ) ):
+            for column in columns.values():
+                if ( len( column ) == row_index ):
+                    column.append( None )
+
+    if ( len( timestamps ) == 0 ):
+        return pandas.DataFrame()
+
+    df = pandas.DataFrame( columns )
+    df[ 'timestamp' ] = parse_timestamps( timestamps )
+    return df
+
+
+def frame_for_query( query ):
+    """Make a Pandas dataframe from the results of a pydruid Query object. Clients
+    that run queries locally may set query.result_df to a dataframe of results, in the
+    form returned by frame_from_result(), which is used as is."""
+    result_df = getattr( query, 'result_df', None )
+    if ( result_df is not None ):
+        return result_df
+
+    return frame_from_result( query.result, query.query_type )
+
+
+def parse_timestamps( timestamps ):
+    """Parse a list of ISO-8601 timestamp strings as a UTC DatetimeIndex, parsing each
+    distinct value only once."""
+    codes, uniques = pandas.factorize( numpy.asarray( timestamps, dtype = object ) )
+    return pandas.to_datetime( uniques, utc = True ).take( codes )
+
+
+def _result_rows( result, query_type ):
+    if ( query_type == 'timeseries' ):
+        for item in result:
+            yield ( item[ 'timestamp' ], item[ 'result' ] )
+
+    elif ( query_type == 'groupBy' ):
+        for item in result:
+            yield ( item[ 'timestamp' ], item[ 'event' ] )
+
+    elif ( query_type == 'topN' ):
+        for item in result:
+            timestamp = item[ 'timestamp' ]
+            for values in item[ 'result' ]:
+                yield ( timestamp, values )
+
+    else:
+        raise ValueError(
+            'Dataframes not available for {0} query results.'.format( query_type ) )
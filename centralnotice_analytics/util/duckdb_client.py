@@ -0,0 +1,340 @@
+# pydruid client that runs queries locally with DuckDB, on columnar extracts of Druid
+# datasources, instead of sending them to a Druid broker. Queries are translated from
+# Druid's JSON form to SQL, so the same query objects (and filters built from
+# CampaignSpecs and config.yaml) work offline. Results are returned in the same form
+# as results from Druid.
+
+import asyncio, os, threading, time
+
+import pandas
+from pydruid.client import BaseDruidClient
+
+import centralnotice_analytics.util.intervals as intervals
+
+BUCKET_ORIGIN = '2000-01-03 00:00:00+00'
+"""Origin for time buckets. It's a Monday, so week buckets start on Mondays, as in
+Druid."""
+
+SQL_AGGREGATORS = {
+    'count': 'COUNT(*)',
+    'longSum': 'CAST( SUM( {0} ) AS BIGINT )',
+    'doubleSum': 'CAST( SUM( {0} ) AS DOUBLE )',
+    'longMin': 'CAST( MIN( {0} ) AS BIGINT )',
+    'longMax': 'CAST( MAX( {0} ) AS BIGINT )',
+    'doubleMin': 'CAST( MIN( {0} ) AS DOUBLE )',
+    'doubleMax': 'CAST( MAX( {0} ) AS DOUBLE )'
+}
+"""SQL for Druid aggregator types, with a placeholder for the quoted field name."""
+
+SUM_AGGREGATOR_TYPES = [ 'count', 'longSum', 'doubleSum' ]
+"""Aggregator types that are 0 for empty timeseries buckets."""
+
+
+class DuckDBDruidClient( BaseDruidClient ):
+    """pydruid client that runs timeseries, groupBy and topN queries locally with
+    DuckDB, on extracts of Druid datasources in Parquet files.
+
+    Each extract needs a column with the time of each row, and columns named as the
+    Druid dimensions and metrics used in queries. Only simple granularities with
+    fixed-length buckets, and 'all', are available. Safe to share between threads.
+
+    Instead of query.result, results are set on query.result_df as a dataframe (see
+    centralnotice_analytics.util.druid_response.frame_for_query()).
+    """
+
+    def __init__( self, datasources, threads = None ):
+        """
+        :param dict datasources: For each Druid datasource name, a dict with the path
+            of its extract ('path', which may include wildcards) and the name of its
+            time column ('time_column', 'timestamp' by default).
+        :param int threads: Number of threads for DuckDB (None to use all cores).
+        """
+        super().__init__( 'offline', 'duckdb' )
+        duckdb = import_duckdb()
+
+        self._datasources = datasources
+        self._connection = duckdb.connect()
+        self._connection.execute( 'SET TimeZone = \'UTC\'' )
+
+        if ( threads ):
+            self._connection.execute( 'SET threads = {0}'.format( int( threads ) ) )
+
+        self._connection_lock = threading.Lock()
+
+
+    async def post_async( self, query ):
+        """Run a query built with self.query_builder without blocking the event loop,
+        and fill it with results."""
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self._post, query )
+
+
+    def _post( self, query ):
+        sql, params = self.sql_for_query( query.query_dict )
+
+        # Each thread needs its own cursor
+        with self._connection_lock:
+            cursor = self._connection.cursor()
+
+        start = time.perf_counter()
+        try:
+            df = cursor.execute( sql, params ).df()
+        finally:
+            cursor.close()
+
+        query.transfer_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        query.result_df = self._finish_result( query.query_dict, df )
+        query.parse_seconds = time.perf_counter() - start
+
+        return query
+
+
+    def sql_for_query( self, query_dict ):
+        """Translate a Druid query in JSON form to DuckDB SQL. Returns a tuple with
+        the SQL and a list of parameters.
+
+        :param dict query_dict: Query, as built by pydruid.
+        """
+        query_type = query_dict[ 'queryType' ]
+        if ( query_type not in ( 'timeseries', 'groupBy', 'topN' ) ):
+            raise ValueError(
+                '{0} queries not available offline.'.format( query_type ) )
+
+        datasource = self._datasource_config( query_dict[ 'dataSource' ] )
+        time_sql = 'CAST( {0} AS TIMESTAMPTZ )'.format(
+            quote_identifier( datasource.get( 'time_column', 'timestamp' ) ) )
+
+        start, end = intervals.parse_interval( interval_of( query_dict ) )
+        bucket_sql, bucket_params = bucket_sql_for(
+            query_dict[ 'granularity' ], time_sql, start )
+
+        dimensions = dimensions_of( query_dict )
+        columns = [ 'epoch_us( {0} ) AS __bucket'.format( bucket_sql ) ]
+        columns += [ '{0} AS {1}'.format( quote_identifier( dimension ),
+            quote_identifier( output_name ) ) for dimension, output_name in dimensions ]
+        columns += [ aggregator_sql( aggregator )
+            for aggregator in query_dict[ 'aggregations' ] ]
+
+        conditions = [ '{0} >= CAST( ? AS TIMESTAMPTZ )'.format( time_sql ),
+            '{0} < CAST( ? AS TIMESTAMPTZ )'.format( time_sql ) ]
+        params = bucket_params + [ start.isoformat(), end.isoformat() ]
+
+        if ( query_dict.get( 'filter' ) ):
+            filter_sql, filter_params = filter_sql_for( query_dict[ 'filter' ] )
+            conditions.append( filter_sql )
+            params += filter_params
+
+        # Group by the bucket and dimensions, which are the first columns
+        sql = 'SELECT {0} FROM read_parquet( {1} ) WHERE {2} GROUP BY {3}'.format(
+            ', '.join( columns ),
+            quote_literal( os.path.expanduser( datasource[ 'path' ] ) ),
+            ' AND '.join( conditions ),
+            ', '.join( str( i + 1 ) for i in range( len( dimensions ) + 1 ) )
+        )
+
+        if ( query_type == 'topN' ):
+            metric = query_dict[ 'metric' ]
+            if ( isinstance( metric, dict ) ):
+                metric = metric[ 'metric' ]
+
+            sql += ( ' QUALIFY row_number() OVER ( PARTITION BY __bucket ' +
+                'ORDER BY {0} DESC ) <= {1}' ).format(
+                    quote_identifier( metric ), int( query_dict[ 'threshold' ] ) )
+
+        # As from Druid, rows are in timestamp order
+        order = [ '__bucket' ] + [ quote_identifier( name ) for _, name in dimensions ]
+
+        limit_spec = query_dict.get( 'limitSpec' )
+        if ( limit_spec ):
+            order = [
+                '{0} {1}'.format( quote_identifier( column[ 'dimension' ] ),
+                    'DESC' if column.get( 'direction' ) == 'descending' else 'ASC' )
+                for column in limit_spec.get( 'columns', [] )
+            ] + order
+
+        sql += ' ORDER BY {0}'.format( ', '.join( order ) )
+
+        if ( limit_spec and ( limit_spec.get( 'limit' ) is not None ) ):
+            sql += ' LIMIT {0}'.format( int( limit_spec[ 'limit' ] ) )
+
+        return ( sql, params )
+
+
+    def _datasource_config( self, datasource ):
+        config = self._datasources.get( datasource )
+        if ( config is None ):
+            raise ValueError(
+                'No offline extract configured for datasource {0}.'.format( datasource ) )
+
+        return config
+
+
+    def _finish_result( self, query_dict, df ):
+        # Put results in the same form as results parsed from Druid: dimensions, then
+        # aggregations, then UTC timestamps
+        if ( len( df ) == 0 ):
+            return pandas.DataFrame()
+
+        df[ 'timestamp' ] = pandas.to_datetime( df.pop( '__bucket' ), unit = 'us',
+            utc = True )
+
+        # Druid fills empty buckets of timeseries queries with zeros
+        granularity = query_dict[ 'granularity' ]
+        if (
+            ( query_dict[ 'queryType' ] == 'timeseries' ) and
+            ( intervals.bucket_size( granularity ) is not None )
+        ):
+            start, end = intervals.parse_interval( interval_of( query_dict ) )
+            buckets = pandas.date_range( intervals.bucket_floor( start, granularity ),
+                end, freq = intervals.BUCKET_SIZES[ granularity ], inclusive = 'left' )
+
+            df = df.set_index( 'timestamp' ).reindex( buckets )
+            for aggregator in query_dict[ 'aggregations' ]:
+                if ( aggregator[ 'type' ] in SUM_AGGREGATOR_TYPES ):
+                    df[ aggregator[ 'name' ] ] = df[ aggregator[ 'name' ] ].fillna( 0 )
+
+            df = df.rename_axis( 'timestamp' ).reset_index()
+            df = df[ list( df.columns[ 1: ] ) + [ 'timestamp' ] ]
+
+        return df
+
+
+def interval_of( query_dict ):
+    query_intervals = query_dict[ 'intervals' ]
+    if ( isinstance( query_intervals, list ) ):
+        if ( len( query_intervals ) != 1 ):
+            raise ValueError( 'Only single intervals are available offline.' )
+
+        return query_intervals[ 0 ]
+
+    return query_intervals
+
+
+def dimensions_of( query_dict ):
+    # Return (dimension, output name) tuples for a query's dimensions
+    if ( query_dict[ 'queryType' ] == 'topN' ):
+        specs = [ query_dict[ 'dimension' ] ]
+    else:
+        specs = query_dict.get( 'dimensions', [] )
+
+    dimensions = []
+    for spec in specs:
+        if ( isinstance( spec, str ) ):
+            dimensions.append( ( spec, spec ) )
+
+        elif ( spec.get( 'type', 'default' ) == 'default' ):
+            dimensions.append(
+                ( spec[ 'dimension' ], spec.get( 'outputName', spec[ 'dimension' ] ) ) )
+
+        else:
+            raise ValueError( 'Dimension spec type "{0}" not available offline.'.format(
+                spec[ 'type' ] ) )
+
+    return dimensions
+
+
+def bucket_sql_for( granularity, time_sql, start ):
+    # Return SQL, and parameters for it, for the start of each row's time bucket
+    if ( granularity == 'all' ):
+        return ( 'CAST( ? AS TIMESTAMPTZ )', [ start.isoformat() ] )
+
+    size = intervals.bucket_size( granularity )
+    if ( size is None ):
+        raise ValueError( 'Granularity {0} not available offline.'.format( granularity ) )
+
+    return (
+        'time_bucket( INTERVAL \'{0} seconds\', {1}, TIMESTAMPTZ \'{2}\' )'.format(
+            int( size.total_seconds() ), time_sql, BUCKET_ORIGIN ),
+        []
+    )
+
+
+def aggregator_sql( aggregator ):
+    sql = SQL_AGGREGATORS.get( aggregator[ 'type' ] )
+    if ( sql is None ):
+        raise ValueError( 'Aggregator type "{0}" not available offline.'.format(
+            aggregator[ 'type' ] ) )
+
+    field = None
+    if ( 'fieldName' in aggregator ):
+        field = quote_identifier( aggregator[ 'fieldName' ] )
+
+    return '{0} AS {1}'.format( sql.format( field ),
+        quote_identifier( aggregator[ 'name' ] ) )
+
+
+def filter_sql_for( filter_json ):
+    """Translate a filter in Druid's JSON form to a SQL condition. Returns a tuple with
+    the SQL and a list of parameters.
+
+    Selector, in, regex, and, or and not filters are supported. As in Druid (and
+    centralnotice_analytics.util.local_filter), null values are treated as ''.
+    """
+    filter_type = filter_json.get( 'type', 'selector' )
+
+    if ( filter_type in ( 'and', 'or' ) ):
+        fields = [ filter_sql_for( field ) for field in filter_json[ 'fields' ] ]
+        if ( len( fields ) == 0 ):
+            return ( 'TRUE' if filter_type == 'and' else 'FALSE', [] )
+
+        return (
+            '( {0} )'.format( ' {0} '.format( filter_type.upper() ).join(
+                sql for sql, _ in fields ) ),
+            [ param for _, params in fields for param in params ]
+        )
+
+    if ( filter_type == 'not' ):
+        sql, params = filter_sql_for( filter_json[ 'field' ] )
+        return ( '( NOT {0} )'.format( sql ), params )
+
+    if ( filter_type not in ( 'selector', 'in', 'regex' ) ):
+        raise ValueError(
+            'Filter type "{0}" not available offline.'.format( filter_type ) )
+
+    column = 'COALESCE( CAST( {0} AS VARCHAR ), \'\' )'.format(
+        quote_identifier( filter_json[ 'dimension' ] ) )
+
+    if ( filter_type == 'selector' ):
+        value = filter_json[ 'value' ]
+        return ( '{0} = ?'.format( column ), [ '' if value is None else str( value ) ] )
+
+    if ( filter_type == 'in' ):
+        values = [ '' if value is None else str( value )
+            for value in filter_json[ 'values' ] ]
+
+        if ( len( values ) == 0 ):
+            return ( 'FALSE', [] )
+
+        return ( '{0} IN ( {1} )'.format( column, ', '.join( [ '?' ] * len( values ) ) ),
+            values )
+
+    # Like Druid regex filters, patterns are unanchored
+    return ( 'regexp_matches( {0}, ? )'.format( column ), [ filter_json[ 'pattern' ] ] )
+
+
+def quote_identifier( name ):
+    return '"{0}"'.format( name.replace( '"', '""' ) )
+
+
+def quote_literal( value ):
+    return '\'{0}\''.format( value.replace( '\'', '\'\'' ) )
+
+
+def make_offline_client( offline_config ):
+    """Make a DuckDB client as per the offline section of config.yaml."""
+    return DuckDBDruidClient(
+        offline_config[ 'datasources' ],
+        offline_config.get( 'threads' )
+    )
+
+
+def import_duckdb():
+    try:
+        import duckdb
+    except ImportError:
+        raise ImportError( 'duckdb is required for offline queries. Install it with ' +
+            'pip install centralnotice_analytics[offline].' ) from None
+
+    return duckdb
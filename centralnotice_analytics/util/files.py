@@ -0,0 +1,34 @@
+# Helpers for writing files
+
+import contextlib, os, tempfile
+
+
+@contextlib.contextmanager
+def atomic_write( filename, mode = 'wb' ):
+    """Context manager that opens a temporary file for writing, in the same directory
+    as filename, and renames it to filename when the block exits without an error.
+    Readers never see a partial file. If the block raises an exception, the temporary
+    file is removed and filename is left as it was.
+
+    The directory is created if it doesn't exist.
+
+    :param str filename: Name of the file to write.
+    :param str mode: Mode to open the temporary file in ('wb' or 'w').
+    """
+    dirname = os.path.dirname( os.path.abspath( filename ) )
+    os.makedirs( dirname, exist_ok = True )
+
+    fd, tmp_filename = tempfile.mkstemp( dir = dirname, suffix = '.tmp' )
+    try:
+        with os.fdopen( fd, mode ) as stream:
+            yield stream
+
+        os.replace( tmp_filename, filename )
+
+    except BaseException:
+        try:
+            os.remove( tmp_filename )
+        except OSError:
+            pass
+
+        raise
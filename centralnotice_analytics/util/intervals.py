@@ -0,0 +1,178 @@
+# Helpers for ISO-8601 intervals and Druid time buckets
+
+import re
+
+import numpy
+import pandas
+
+BUCKET_SIZES = {
+    'minute': pandas.Timedelta( minutes = 1 ),
+    'fifteen_minute': pandas.Timedelta( minutes = 15 ),
+    'thirty_minute': pandas.Timedelta( minutes = 30 ),
+    'hour': pandas.Timedelta( hours = 1 ),
+    'day': pandas.Timedelta( days = 1 ),
+    'week': pandas.Timedelta( weeks = 1 )
+}
+"""Sizes of Druid simple granularities that have fixed-length buckets."""
+
+_DURATION_RE = re.compile(
+    r'^P(?:(?P<years>\d+)Y)?(?:(?P<months>\d+)M)?(?:(?P<weeks>\d+)W)?' +
+    r'(?:(?P<days>\d+)D)?(?:T(?:(?P<hours>\d+)H)?(?:(?P<minutes>\d+)M)?' +
+    r'(?:(?P<seconds>\d+)S)?)?$'
+)
+
+
+def parse_duration( duration ):
+    """Parse an ISO-8601 duration, such as 'P3D' or 'PT6H', as a pandas.DateOffset."""
+    match = _DURATION_RE.match( duration )
+    if ( ( match is None ) or ( duration in ( 'P', 'PT' ) ) ):
+        raise ValueError( 'Invalid ISO-8601 duration "{0}".'.format( duration ) )
+
+    parts = { k: int( v ) for k, v in match.groupdict().items() if v is not None }
+    return pandas.DateOffset( **parts )
+
+
+def duration_to_timedelta( duration ):
+    """Return a fixed-length duration as a pandas.Timedelta, or None for durations
+    that include years or months."""
+    offset = parse_duration( duration )
+    kwds = offset.kwds
+
+    if ( kwds.get( 'years' ) or kwds.get( 'months' ) ):
+        return None
+
+    return pandas.Timedelta(
+        weeks = kwds.get( 'weeks', 0 ),
+        days = kwds.get( 'days', 0 ),
+        hours = kwds.get( 'hours', 0 ),
+        minutes = kwds.get( 'minutes', 0 ),
+        seconds = kwds.get( 'seconds', 0 )
+    )
+
+
+def parse_timestamp( timestamp ):
+    """Parse an ISO-8601 timestamp as a UTC pandas.Timestamp. Timestamps without a
+    time zone are taken to be UTC, as Druid does."""
+    ts = pandas.Timestamp( timestamp )
+
+    if ( ts.tzinfo is None ):
+        return ts.tz_localize( 'UTC' )
+
+    return ts.tz_convert( 'UTC' )
+
+
+def parse_interval( interval ):
+    """Parse an ISO-8601 interval ('start/end', 'start/duration' or
+    'duration/end') as a tuple of UTC pandas.Timestamps."""
+    parts = interval.split( '/' )
+    if ( len( parts ) != 2 ):
+        raise ValueError( 'Invalid ISO-8601 interval "{0}".'.format( interval ) )
+
+    start_str, end_str = parts
+
+    if ( start_str.startswith( 'P' ) ):
+        end = parse_timestamp( end_str )
+        return ( end - parse_duration( start_str ), end )
+
+    start = parse_timestamp( start_str )
+
+    if ( end_str.startswith( 'P' ) ):
+        return ( start, start + parse_duration( end_str ) )
+
+    return ( start, parse_timestamp( end_str ) )
+
+
+def format_timestamp( ts ):
+    return ts.tz_convert( 'UTC' ).strftime( '%Y-%m-%dT%H:%M:%SZ' )
+
+
+def format_interval( start, end ):
+    return '{0}/{1}'.format( format_timestamp( start ), format_timestamp( end ) )
+
+
+def bucket_size( granularity ):
+    """Return the length of buckets for a granularity, or None if the granularity
+    does not have fixed-length buckets (for example, 'all', 'month' or a period
+    granularity)."""
+    if ( not isinstance( granularity, str ) ):
+        return None
+
+    return BUCKET_SIZES.get( granularity )
+
+
+def bucket_floor( ts, granularity ):
+    """Return the start of the bucket containing ts. Buckets are aligned in UTC, as
+    for Druid simple granularities, and weeks start on Monday."""
+    if ( granularity == 'week' ):
+        day = ts.normalize()
+        return day - pandas.Timedelta( days = day.weekday() )
+
+    return ts.floor( BUCKET_SIZES[ granularity ] )
+
+
+def is_bucket_aligned( ts, granularity ):
+    return bucket_floor( ts, granularity ) == ts
+
+
+def bucket_starts( start, end, granularity ):
+    """Return a DatetimeIndex with the start of each bucket in [start, end). start
+    must be aligned to the granularity."""
+    step = BUCKET_SIZES[ granularity ]
+    periods = int( ( end - start ) // step )
+    return pandas.date_range( start, periods = periods, freq = step )
+
+
+def split_interval( interval, chunk_duration ):
+    """Split an ISO-8601 interval into consecutive chunks of an ISO-8601 duration. The
+    last chunk may be shorter. Returns a list of (start, end) tuples."""
+    start, end = parse_interval( interval )
+    step = parse_duration( chunk_duration )
+
+    chunks = []
+    chunk_start = start
+    while ( chunk_start < end ):
+        chunk_end = min( chunk_start + step, end )
+        if ( chunk_end <= chunk_start ):
+            raise ValueError(
+                'Invalid duration "{0}" for splitting interval.'.format( chunk_duration ) )
+
+        chunks.append( ( chunk_start, chunk_end ) )
+        chunk_start = chunk_end
+
+    return chunks
+
+
+def local_bucket_starts( timestamps, granularity, tz = 'UTC' ):
+    """For a Series of UTC timestamps, return a Series with the start of the bucket of
+    the given granularity containing each timestamp, in time zone tz.
+
+    Buckets of a day or longer ('day', 'week' or 'month') start at local midnight, and
+    weeks start on Monday. Shorter buckets are aligned in UTC.
+    """
+    if ( granularity in BUCKET_SIZES and BUCKET_SIZES[ granularity ] < BUCKET_SIZES[ 'day' ] ):
+        return timestamps.dt.floor( BUCKET_SIZES[ granularity ] ).dt.tz_convert( tz )
+
+    # Find bucket starts in local wall time, then convert back to time-zone-aware
+    # timestamps
+    wall_times = timestamps.dt.tz_convert( tz ).dt.tz_localize( None )
+
+    if ( granularity == 'day' ):
+        starts = wall_times.dt.normalize()
+
+    elif ( granularity == 'week' ):
+        days = wall_times.dt.normalize()
+        starts = days - pandas.to_timedelta( days.dt.weekday, unit = 'D' )
+
+    elif ( granularity == 'month' ):
+        starts = wall_times.dt.to_period( 'M' ).dt.start_time
+
+    else:
+        raise ValueError( 'Invalid granularity "{0}".'.format( granularity ) )
+
+    # Where a DST change makes midnight ambiguous, the day starts at the first one.
+    # Where it makes midnight not exist, the day starts at the first time that does.
+    return starts.dt.tz_localize(
+        tz,
+        ambiguous = numpy.ones( len( starts ), dtype = bool ),
+        nonexistent = 'shift_forward'
+    )
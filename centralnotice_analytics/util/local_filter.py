@@ -0,0 +1,111 @@
+# Evaluate Druid filters locally, on dataframes of query results
+
+import re
+
+import numpy
+import pandas
+
+
+def evaluate( filter_json, df ):
+    """Return a boolean numpy array that is True for rows of df that match a filter.
+
+    Selector, in, regex, and, or and not filters are supported. As in Druid, null
+    values match selectors for null or ''. Columns that are Categoricals are evaluated
+    once for each category, rather than once for each row.
+
+    :param dict filter_json: Filter in Druid's JSON form.
+    :param pandas.DataFrame df: Dataframe with a column for each dimension in the
+        filter.
+    """
+    filter_type = filter_json.get( 'type', 'selector' )
+
+    if ( filter_type == 'and' ):
+        mask = numpy.ones( len( df ), dtype = bool )
+        for field in filter_json[ 'fields' ]:
+            mask &= evaluate( field, df )
+
+        return mask
+
+    if ( filter_type == 'or' ):
+        mask = numpy.zeros( len( df ), dtype = bool )
+        for field in filter_json[ 'fields' ]:
+            mask |= evaluate( field, df )
+
+        return mask
+
+    if ( filter_type == 'not' ):
+        return ~evaluate( filter_json[ 'field' ], df )
+
+    if ( filter_type not in ( 'selector', 'in', 'regex' ) ):
+        raise ValueError(
+            'Filter type "{0}" not available for local filtering.'.format( filter_type ) )
+
+    dimension = filter_json[ 'dimension' ]
+    if ( dimension not in df.columns ):
+        raise ValueError(
+            'Dimension "{0}" needed to evaluate filter is missing.'.format( dimension ) )
+
+    column = df[ dimension ]
+
+    if ( filter_type == 'selector' ):
+        value = filter_json[ 'value' ]
+        if ( value is None or value == '' ):
+            return _column_mask( column, lambda values: values == '', True )
+
+        return _column_mask( column, lambda values: values == value, False )
+
+    if ( filter_type == 'in' ):
+        values = filter_json[ 'values' ]
+        return _column_mask( column, lambda v: v.isin( values ),
+            ( None in values ) or ( '' in values ) )
+
+    pattern = re.compile( filter_json[ 'pattern' ] )
+    return _column_mask(
+        column,
+        lambda values: numpy.array(
+            [ pattern.search( str( v ) ) is not None for v in values ], dtype = bool ),
+        pattern.search( '' ) is not None
+    )
+
+
+def label_rows( df, labelled_filters ):
+    """Return a Categorical with, for each row of df, the label of the first filter
+    that the row matches, or NaN if it matches none.
+
+    :param pandas.DataFrame df: Dataframe to label.
+    :param dict labelled_filters: Filters in Druid's JSON form, by label, in order.
+    """
+    codes = numpy.full( len( df ), -1, dtype = numpy.int64 )
+
+    for code, filter_json in enumerate( labelled_filters.values() ):
+        codes[ ( codes == -1 ) & evaluate( filter_json, df ) ] = code
+
+    return pandas.Categorical.from_codes( codes, categories = list( labelled_filters ) )
+
+
+def filter_dimensions( filter_json ):
+    """Return the set of dimensions used in a filter."""
+    filter_type = filter_json.get( 'type', 'selector' )
+
+    if ( filter_type in ( 'and', 'or' ) ):
+        return set().union(
+            *[ filter_dimensions( field ) for field in filter_json[ 'fields' ] ] )
+
+    if ( filter_type == 'not' ):
+        return filter_dimensions( filter_json[ 'field' ] )
+
+    return { filter_json[ 'dimension' ] }
+
+
+def _column_mask( column, predicate, match_null ):
+    # Apply predicate to the distinct values of Categoricals, or to all the values of
+    # other columns. Nulls get match_null.
+    if ( isinstance( column.dtype, pandas.CategoricalDtype ) ):
+        category_mask = numpy.append(
+            numpy.asarray( predicate( column.cat.categories ), dtype = bool ), match_null )
+
+        # Null values have code -1, which picks the last element
+        return category_mask[ column.cat.codes.to_numpy() ]
+
+    mask = numpy.asarray( predicate( column ), dtype = bool )
+    return numpy.where( column.isnull().to_numpy(), match_null, mask )
@@ -1,4 +1,13 @@
-# Temporay hack to get around Jupyter proxy settings
+# pydruid clients that send queries through a pluggable HTTP transport. The urllib
+# transport can bypass system proxy settings (originally a hack to get around Jupyter
+# proxy settings). The pooled transport keeps persistent connections to the broker.
+# The aiohttp transport sends queries from asyncio code without blocking the event
+# loop. Requests that fail with server or connection errors are retried, and slow
+# requests may be hedged (see RetryPolicy and HedgePolicy).
+
+import asyncio, collections, concurrent.futures, http.client, json, math, queue
+import random, ssl, threading, time, weakref
+import urllib.error, urllib.parse, urllib.request
 
 from pydruid.client import *
 import centralnotice_analytics as cna
@@ -6,50 +15,674 @@ import centralnotice_analytics as cna
 py_druid_query = None
 """pydruid query object, set up as per config.yaml"""
 
-class PyDruidIgnoreProxy(PyDruid):
-    def _post(self, query):
+_py_druid_query_lock = threading.Lock()
+
+RETRYABLE_ERRORS = ( OSError, http.client.HTTPException, asyncio.TimeoutError )
+"""Exceptions raised by transports for connection errors and timeouts, after which
+requests are retried. (OSError includes ConnectionError, socket timeouts and
+urllib.error.URLError.)"""
+
+_async_retryable_errors = None
+
+
+class RetryPolicy:
+    """When and how long to wait before retrying Druid requests.
+
+    Requests that fail with a 5xx response or a connection error are retried, after
+    an exponential backoff with full jitter: a random wait between 0 and
+    backoff * 2 ** attempt seconds (at most max_backoff), so that many clients
+    retrying at once don't all hit the broker at the same time.
+    """
+
+    def __init__( self, retries = 2, backoff = 0.5, max_backoff = 30.0 ):
+        """
+        :param int retries: Maximum number of retries for each request.
+        :param float backoff: Seconds of backoff before the first retry, at most.
+        :param float max_backoff: Maximum seconds of backoff before any retry.
+        """
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+
+    def should_retry( self, attempt, status = None ):
+        """Return True if a request should be retried after attempt (counting from
+        0), which failed with a connection error or, if status is set, returned that
+        HTTP status."""
+        if ( attempt >= self.retries ):
+            return False
+
+        return ( status is None ) or ( status >= 500 )
+
+
+    def backoff_seconds( self, attempt ):
+        """Return seconds to wait before retrying after attempt (counting from 0)."""
+        return random.uniform( 0, min( self.max_backoff, self.backoff * 2 ** attempt ) )
+
+
+class HedgePolicy:
+    """When to send a duplicate of a slow Druid request.
+
+    Latencies of recent successful requests are kept. If a request takes longer than
+    the given percentile of them (and at least min_seconds), a duplicate is sent, and
+    whichever returns first is used. This cuts the latency added by a slow broker or
+    historical node, at the cost of a few extra requests. Only used once min_samples
+    latencies have been recorded. Safe to share between threads.
+    """
+
+    def __init__( self, percentile = 95, min_seconds = 1.0, min_samples = 20,
+            window = 200 ):
+        """
+        :param float percentile: Percentile of recent latencies after which to send a
+            duplicate request.
+        :param float min_seconds: Minimum seconds to wait before sending a duplicate.
+        :param int min_samples: Number of latencies needed before hedging.
+        :param int window: Number of recent latencies to keep.
+        """
+        self.percentile = percentile
+        self.min_seconds = min_seconds
+        self.min_samples = min_samples
+
+        self._latencies = collections.deque( maxlen = window )
+        self._lock = threading.Lock()
+
+
+    def record( self, seconds ):
+        """Record the latency of a successful request."""
+        with self._lock:
+            self._latencies.append( seconds )
+
+
+    def threshold( self ):
+        """Return seconds after which to send a duplicate request, or None if too few
+        latencies have been recorded."""
+        with self._lock:
+            if ( len( self._latencies ) < self.min_samples ):
+                return None
+
+            latencies = sorted( self._latencies )
+
+        index = max( 0, math.ceil( self.percentile / 100 * len( latencies ) ) - 1 )
+        return max( self.min_seconds, latencies[ index ] )
+
+
+class UrllibTransport:
+    """HTTP transport that opens a new urllib connection for each request."""
+
+    def __init__( self, bypass_proxy = False, timeout = None ):
+        """
+        :param bool bypass_proxy: Ignore system proxy settings.
+        :param float timeout: Seconds to wait to connect or for data (None to wait
+            indefinitely).
+        """
+        self._bypass_proxy = bypass_proxy
+        self._timeout = timeout
+
+
+    def post( self, url, body, headers ):
+        """Send a POST request. Returns a tuple with the response's status code, reason
+        phrase and body."""
+        req = urllib.request.Request( url, body, headers )
+
+        if ( self._bypass_proxy ):
+            opener = urllib.request.build_opener( urllib.request.ProxyHandler( {} ) )
+        else:
+            opener = urllib.request.build_opener()
+
+        try:
+            res = opener.open( req, timeout = self._timeout )
+        except urllib.error.HTTPError as e:
+            return ( e.code, e.reason, e.read() )
+
         try:
-            headers, querystr, url = self._prepare_url_headers_and_body(query)
-            req = urllib.request.Request(url, querystr, headers)
-            proxy_handler = urllib.request.ProxyHandler({})
-            opener = urllib.request.build_opener(proxy_handler) 
-            res = opener.open(req)
-            data = res.read().decode("utf-8")
+            return ( res.status, res.reason, res.read() )
+        finally:
             res.close()
-        except urllib.error.HTTPError:
-            _, e, _ = sys.exc_info()
-            err = None
-            if e.code == 500:
-                # has Druid returned an error?
-                try:
-                    err = json.loads(e.read().decode("utf-8"))
-                except (ValueError, AttributeError, KeyError):
-                    pass
-                else:
-                    err = err.get('error', None)
-
-            raise IOError('{0} \n Druid Error: {1} \n Query is: {2}'.format(
-                    e, err, json.dumps(query.query_dict, indent=4)))
+
+
+class PooledTransport:
+    """HTTP transport that keeps a pool of persistent (keep-alive) connections to a
+    single host. Safe to share between threads.
+
+    At most pool_size requests are sent at once; further requests wait for a free
+    connection.
+    """
+
+    def __init__( self, url, pool_size = 8, timeout = None, bypass_proxy = False ):
+        """
+        :param str url: Base URL of the host that requests will be sent to.
+        :param int pool_size: Maximum number of connections.
+        :param float timeout: Seconds to wait to connect or for data (None to wait
+            indefinitely).
+        :param bool bypass_proxy: Ignore system proxy settings.
+        """
+        parts = urllib.parse.urlsplit( url )
+        self._scheme = parts.scheme
+        self._host = parts.hostname
+        self._port = parts.port
+        self._timeout = timeout
+
+        self._proxy = None
+        if ( ( not bypass_proxy ) and ( not urllib.request.proxy_bypass( self._host ) ) ):
+            proxy_url = urllib.request.getproxies().get( self._scheme )
+            if ( proxy_url ):
+                self._proxy = urllib.parse.urlsplit( proxy_url )
+
+        self._idle_connections = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore( pool_size )
+
+
+    def post( self, url, body, headers ):
+        """Send a POST request. Returns a tuple with the response's status code, reason
+        phrase and body."""
+        path = self._request_path( url )
+
+        with self._slots:
+            try:
+                conn = self._idle_connections.get_nowait()
+                reused = True
+            except queue.Empty:
+                conn = self._connect()
+                reused = False
+
+            try:
+                return self._request( conn, path, body, headers )
+
+            except (
+                http.client.RemoteDisconnected,
+                ConnectionResetError,
+                BrokenPipeError
+            ):
+                # The server may have closed an idle connection. If so, retry once
+                # on a new connection.
+                if ( not reused ):
+                    raise
+
+                return self._request( self._connect(), path, body, headers )
+
+
+    def close( self ):
+        """Close idle connections."""
+        while True:
+            try:
+                self._idle_connections.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+    def _request( self, conn, path, body, headers ):
+        try:
+            conn.request( 'POST', path, body, headers )
+            res = conn.getresponse()
+            data = res.read()
+        except:
+            conn.close()
+            raise
+
+        if ( res.will_close ):
+            conn.close()
         else:
-            query.parse(data)
-            return query
+            self._idle_connections.put( conn )
+
+        return ( res.status, res.reason, data )
+
+
+    def _connect( self ):
+        if ( self._proxy is None ):
+            return self._new_connection( self._scheme, self._host, self._port )
+
+        conn = self._new_connection(
+            self._proxy.scheme, self._proxy.hostname, self._proxy.port )
+
+        # HTTPS requests are tunneled through the proxy
+        if ( self._scheme == 'https' ):
+            conn.set_tunnel( self._host, self._port )
+
+        return conn
+
+
+    def _new_connection( self, scheme, host, port ):
+        if ( scheme == 'https' ):
+            return http.client.HTTPSConnection( host, port, timeout = self._timeout,
+                context = ssl.create_default_context() )
+
+        return http.client.HTTPConnection( host, port, timeout = self._timeout )
+
+
+    def _request_path( self, url ):
+        # Plain HTTP requests sent to a proxy use the full URL
+        if ( ( self._proxy is not None ) and ( self._scheme == 'http' ) ):
+            return url
+
+        parts = urllib.parse.urlsplit( url )
+        return parts.path + ( '?' + parts.query if parts.query else '' )
+
+
+class AiohttpTransport:
+    """Non-blocking HTTP transport for asyncio code, using aiohttp.
+
+    Each event loop gets its own session, and a semaphore that limits the number of
+    requests in flight at once on that loop. aiohttp is only imported when the first
+    request is sent.
+    """
+
+    def __init__( self, max_concurrent_requests = 8, timeout = None,
+            bypass_proxy = False ):
+        """
+        :param int max_concurrent_requests: Maximum number of requests sent at once
+            from each event loop; further requests wait.
+        :param float timeout: Seconds to wait for each request to complete (None to
+            wait indefinitely).
+        :param bool bypass_proxy: Ignore system proxy settings.
+        """
+        self._max_concurrent_requests = max_concurrent_requests
+        self._timeout = timeout
+        self._bypass_proxy = bypass_proxy
+        self._loop_state = weakref.WeakKeyDictionary()
+
+
+    async def post( self, url, body, headers ):
+        """Send a POST request. Returns a tuple with the response's status code, reason
+        phrase and body."""
+        session, semaphore = self._get_loop_state()
+
+        async with semaphore:
+            async with session.post( url, data = body, headers = headers ) as res:
+                return ( res.status, res.reason, await res.read() )
+
+
+    async def close( self ):
+        """Close the session for the running event loop."""
+        state = self._loop_state.pop( asyncio.get_running_loop(), None )
+        if ( state is not None ):
+            await state[0].close()
+
+
+    def _get_loop_state( self ):
+        loop = asyncio.get_running_loop()
+        state = self._loop_state.get( loop )
+
+        if ( state is None ):
+            aiohttp = import_aiohttp()
+            session = aiohttp.ClientSession(
+                timeout = aiohttp.ClientTimeout( total = self._timeout ),
+                trust_env = not self._bypass_proxy
+            )
+
+            state = ( session, asyncio.Semaphore( self._max_concurrent_requests ) )
+            self._loop_state[ loop ] = state
+
+        return state
+
+
+class PyDruidTransport( BaseDruidClient ):
+    """pydruid client that sends queries through a transport object.
+
+    Failed requests are retried as per a RetryPolicy, and slow requests are hedged as
+    per a HedgePolicy, if one is set. The numbers of retries and duplicate requests
+    are recorded on each query object, as retries and hedged_requests.
+    """
+
+    HEDGE_WORKERS = 32
+    """Maximum number of hedged requests in flight at once, from blocking queries.
+
+    Blocking requests can't be cancelled, so the request that loses a race keeps its
+    thread, and its connection from the transport's pool, until it finishes. This is
+    bounded by the timeout in config.yaml, which should be set when hedging.
+    Requests that lose races with async queries are cancelled."""
+
+    def __init__( self, url, endpoint, transport, async_transport = None,
+            retry_policy = None, hedge_policy = None ):
+        """
+        :param transport: Transport for blocking queries.
+        :param async_transport: Transport for queries sent with post_async().
+        :param RetryPolicy retry_policy: When to retry failed requests. By default,
+            requests are not retried.
+        :param HedgePolicy hedge_policy: When to send duplicates of slow requests. By
+            default, requests are not hedged.
+        """
+        super().__init__( url, endpoint )
+        self.transport = transport
+        self.async_transport = async_transport
+        self.retry_policy = retry_policy or RetryPolicy( retries = 0 )
+        self.hedge_policy = hedge_policy
+
+        self._hedge_executor = None
+        self._hedge_executor_lock = threading.Lock()
+
+
+    async def post_async( self, query ):
+        """Send a query built with self.query_builder without blocking the event loop,
+        and fill it with results."""
+        headers, querystr, url = self._prepare_url_headers_and_body( query )
+        query.retries = 0
+        query.hedged_requests = 0
+        attempt = 0
+
+        start = time.perf_counter()
+        while True:
+            try:
+                status, reason, data = await self._send_async(
+                    query, url, querystr, headers )
+
+            except async_retryable_errors():
+                if ( not self.retry_policy.should_retry( attempt ) ):
+                    raise
+
+            else:
+                if ( not self.retry_policy.should_retry( attempt, status ) ):
+                    break
+
+            await asyncio.sleep( self.retry_policy.backoff_seconds( attempt ) )
+            attempt += 1
+            query.retries += 1
+
+        query.transfer_seconds = time.perf_counter() - start
+
+        # Parse large responses off the event loop
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self._set_result, query, status, reason, data )
+
+
+    def _post( self, query ):
+        headers, querystr, url = self._prepare_url_headers_and_body( query )
+        query.retries = 0
+        query.hedged_requests = 0
+        attempt = 0
+
+        # Timings and size are recorded on the query, for QueryStats
+        start = time.perf_counter()
+        while True:
+            try:
+                status, reason, data = self._send( query, url, querystr, headers )
+
+            except RETRYABLE_ERRORS:
+                if ( not self.retry_policy.should_retry( attempt ) ):
+                    raise
+
+            else:
+                if ( not self.retry_policy.should_retry( attempt, status ) ):
+                    break
+
+            time.sleep( self.retry_policy.backoff_seconds( attempt ) )
+            attempt += 1
+            query.retries += 1
+
+        query.transfer_seconds = time.perf_counter() - start
+
+        return self._set_result( query, status, reason, data )
+
+
+    def _send( self, query, url, body, headers ):
+        # Send a request, and, if it's slow, a duplicate. Returns the first successful
+        # response, or the last failure.
+        threshold = self.hedge_policy.threshold() if self.hedge_policy else None
+
+        if ( threshold is None ):
+            return self._timed_post( url, body, headers )
+
+        executor = self._get_hedge_executor()
+        pending = { executor.submit( self._timed_post, url, body, headers ) }
+
+        done, pending = concurrent.futures.wait( pending, timeout = threshold )
+        if ( not done ):
+            query.hedged_requests += 1
+            pending.add( executor.submit( self._timed_post, url, body, headers ) )
+
+        while True:
+            # The other request, if any, is left to finish in the background
+            first = _first_response( done, pending )
+            if ( first is not None ):
+                return first.result()
+
+            done, pending = concurrent.futures.wait(
+                pending, return_when = concurrent.futures.FIRST_COMPLETED )
+
+
+    async def _send_async( self, query, url, body, headers ):
+        threshold = self.hedge_policy.threshold() if self.hedge_policy else None
+
+        if ( threshold is None ):
+            return await self._timed_post_async( url, body, headers )
+
+        pending = { asyncio.ensure_future( self._timed_post_async( url, body, headers ) ) }
+
+        try:
+            done, pending = await asyncio.wait( pending, timeout = threshold )
+            if ( not done ):
+                query.hedged_requests += 1
+                pending.add( asyncio.ensure_future(
+                    self._timed_post_async( url, body, headers ) ) )
+
+            while True:
+                first = _first_response( done, pending )
+                if ( first is not None ):
+                    return first.result()
+
+                done, pending = await asyncio.wait(
+                    pending, return_when = asyncio.FIRST_COMPLETED )
+
+        finally:
+            # Unlike blocking requests, the slower request can be cancelled
+            for task in pending:
+                task.cancel()
+
+
+    def _timed_post( self, url, body, headers ):
+        start = time.perf_counter()
+        response = self.transport.post( url, body, headers )
+        self._record_latency( response, time.perf_counter() - start )
+        return response
+
+
+    async def _timed_post_async( self, url, body, headers ):
+        start = time.perf_counter()
+        response = await self.async_transport.post( url, body, headers )
+        self._record_latency( response, time.perf_counter() - start )
+        return response
+
+
+    def _record_latency( self, response, seconds ):
+        if ( ( self.hedge_policy is not None ) and ( response[ 0 ] < 500 ) ):
+            self.hedge_policy.record( seconds )
+
+
+    def _get_hedge_executor( self ):
+        with self._hedge_executor_lock:
+            if ( self._hedge_executor is None ):
+                self._hedge_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers = PyDruidTransport.HEDGE_WORKERS )
+
+            return self._hedge_executor
+
+
+    def _set_result( self, query, status, reason, data ):
+        if ( status != 200 ):
+            raise druid_error( query, status, reason, data )
+
+        if ( not data ):
+            raise IOError( 'Empty result for {0} query'.format( query.query_type ) )
+
+        # Parse the response bytes directly. Unlike query.parse(), this doesn't keep
+        # a decoded copy of the whole response in query.result_json.
+        start = time.perf_counter()
+        query.result = json.loads( data )
+        query.parse_seconds = time.perf_counter() - start
+        query.response_bytes = len( data )
+
+        return query
+
+
+class PyDruidIgnoreProxy( PyDruidTransport ):
+    """pydruid client that ignores system proxy settings."""
+
+    def __init__( self, url, endpoint, timeout = None, retry_policy = None ):
+        super().__init__( url, endpoint,
+            UrllibTransport( bypass_proxy = True, timeout = timeout ),
+            retry_policy = retry_policy )
+
+
+class DruidHTTPError( IOError ):
+    """Error for an HTTP error response to a query."""
+
+    def __init__( self, message, status ):
+        super().__init__( message )
+
+        self.status = status
+        """HTTP status code of the response"""
+
+
+def _first_response( done, pending ):
+    # Of hedged requests (futures or tasks), return the first done that succeeded, or,
+    # if none are pending, one that failed. Return None to keep waiting.
+    for future in done:
+        if ( ( future.exception() is None ) and ( future.result()[ 0 ] < 500 ) ):
+            return future
+
+    if ( ( not pending ) and done ):
+        return next( iter( done ) )
+
+    return None
+
+
+def druid_error( query, status, reason, data ):
+    """Make a DruidHTTPError for an HTTP error response to a query, including any
+    error message returned by Druid."""
+    err = None
+    if ( status == 500 ):
+        # has Druid returned an error?
+        try:
+            err = json.loads( data.decode( 'utf-8' ) )
+        except ( ValueError, AttributeError, KeyError ):
+            pass
+        else:
+            err = err.get( 'error', None )
+
+    return DruidHTTPError(
+        'HTTP Error {0}: {1} \n Druid Error: {2} \n Query is: {3}'.format(
+            status, reason, err, json.dumps( query.query_dict, indent = 4 ) ),
+        status
+    )
+
+
+def make_transport( druid_config ):
+    """Make an HTTP transport as per the druid section of config.yaml."""
+    transport = druid_config.get( 'transport', 'pooled' )
+    bypass_proxy = druid_config.get( 'bypass_proxy', False )
+    timeout = druid_config.get( 'timeout' )
+
+    if ( transport == 'pooled' ):
+        return PooledTransport(
+            druid_config[ 'url' ],
+            druid_config.get( 'pool_size', 8 ),
+            timeout,
+            bypass_proxy
+        )
+
+    if ( transport == 'urllib' ):
+        return UrllibTransport( bypass_proxy, timeout )
+
+    raise ValueError( 'Invalid Druid transport "{0}" configured.'.format( transport ) )
+
+
+def make_async_transport( druid_config ):
+    """Make an asyncio HTTP transport as per the druid section of config.yaml."""
+    return AiohttpTransport(
+        druid_config.get( 'max_concurrent_requests', 8 ),
+        druid_config.get( 'timeout' ),
+        druid_config.get( 'bypass_proxy', False )
+    )
+
+
+def make_retry_policy( druid_config ):
+    """Make a RetryPolicy as per the druid section of config.yaml."""
+    return RetryPolicy(
+        druid_config.get( 'retries', 2 ),
+        druid_config.get( 'retry_backoff', 0.5 ),
+        druid_config.get( 'retry_max_backoff', 30.0 )
+    )
+
+
+def make_hedge_policy( druid_config ):
+    """Make a HedgePolicy as per the druid section of config.yaml, or return None if
+    hedging is not enabled."""
+    if ( not druid_config.get( 'hedge_percentile' ) ):
+        return None
+
+    return HedgePolicy(
+        druid_config[ 'hedge_percentile' ],
+        druid_config.get( 'hedge_min_seconds', 1.0 )
+    )
+
+
+def async_retryable_errors():
+    """Return exceptions after which requests sent with post_async() are retried:
+    RETRYABLE_ERRORS and, if aiohttp is installed, aiohttp.ClientError (which includes
+    ServerDisconnectedError and ClientPayloadError, and isn't an OSError)."""
+    global _async_retryable_errors
+
+    if ( _async_retryable_errors is None ):
+        try:
+            import aiohttp
+            _async_retryable_errors = RETRYABLE_ERRORS + ( aiohttp.ClientError, )
+        except ImportError:
+            _async_retryable_errors = RETRYABLE_ERRORS
+
+    return _async_retryable_errors
+
+
+def import_aiohttp():
+    try:
+        import aiohttp
+    except ImportError:
+        raise ImportError( 'aiohttp is required for async queries. Install it with ' +
+            'pip install centralnotice_analytics[async].' ) from None
+
+    return aiohttp
+
 
 def get_py_druid_query():
+    """Return the shared pydruid client object. If offline queries are enabled in
+    config.yaml, that's a client that runs queries locally on extracts of Druid data.
+
+    The client may be used from several threads at once, as long as callers use the
+    Query object returned by each query method, and not the client's last_query or
+    export_pandas().
+    """
     global py_druid_query
 
     if ( py_druid_query is not None ):
         return py_druid_query
 
-    if ( cna.config[ 'druid' ][ 'bypass_proxy' ] ):
-        py_druid_query = PyDruidIgnoreProxy(
-            cna.config[ 'druid' ][ 'url' ],
-            cna.config[ 'druid' ][ 'endpoint' ]
-        )
+    with _py_druid_query_lock:
+        if ( py_druid_query is not None ):
+            return py_druid_query
+
+        offline_config = cna.config.get( 'offline' ) or {}
+        if ( offline_config.get( 'enabled' ) ):
+            from centralnotice_analytics.util.duckdb_client import make_offline_client
+            py_druid_query = make_offline_client( offline_config )
+            return py_druid_query
 
-    else:
-        py_druid_query = PyDruid(
+        py_druid_query = PyDruidTransport(
             cna.config[ 'druid' ][ 'url' ],
-            cna.config[ 'druid' ][ 'endpoint' ]
+            cna.config[ 'druid' ][ 'endpoint' ],
+            make_transport( cna.config[ 'druid' ] ),
+            make_async_transport( cna.config[ 'druid' ] ),
+            make_retry_policy( cna.config[ 'druid' ] ),
+            make_hedge_policy( cna.config[ 'druid' ] )
         )
 
-    return py_druid_query
\ No newline at end of file
+    return py_druid_query
+
+
+def backend_key():
+    """Return a dict that identifies where queries are run, as per config.yaml: the
+    offline extracts, if offline queries are enabled, or the Druid broker. Results from
+    different backends may differ, so they're cached separately."""
+    offline_config = cna.config.get( 'offline' ) or {}
+    if ( offline_config.get( 'enabled' ) ):
+        return { 'offline': offline_config.get( 'datasources' ) }
+
+    return { 'druid': '{0}/{1}'.format(
+        cna.config[ 'druid' ][ 'url' ], cna.config[ 'druid' ][ 'endpoint' ] ) }
@@ -8,12 +8,21 @@ setup( name = 'centralnotice_analytics',
     install_requires = [
         'pyyaml >= 3.12',
         'pydruid >= 0.3.1',
-        'pandas >= 0.22.0'
+        'pandas >= 1.4'
     ],
     extras_require = {
         'plots': [
-            'matplotlib >= 2.1.1',
+            'matplotlib >= 3.1',
             'numpy >= 1.13.3'
+        ],
+        'async': [
+            'aiohttp >= 3.0'
+        ],
+        'export': [
+            'pyarrow >= 1.0'
+        ],
+        'offline': [
+            'duckdb >= 0.9'
         ]
     }
 )
\ No newline at end of file